@@ -0,0 +1,159 @@
+from model import Schelling
+from kernels import KERNELS
+from graph import BigGraph
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+
+# Fields compared between two result files, higher is better for the rates and lower for the times
+RATES = ['rounds_per_s', 'moves_per_s']
+TIMES = ['configure_s', 'statistics_s', 'neighbourhood_s']
+
+
+def timed(function, repeat):
+    # Median wall time of repeat calls, and the result of the last call
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2], result
+
+
+def race_ratios(empty_ratio):
+    return [(1 - empty_ratio) / 2, (1 - empty_ratio) / 2, 0, 0, 0]
+
+
+def benchmark_case(engine, size, depth, empty_ratio, threshold, rounds, repeat, seed, warmup=0):
+    def build():
+        return Schelling(size, size, empty_ratio, threshold, depth, race_ratios(empty_ratio), engine=engine, seed=seed)
+
+    schelling = build()
+    configure, _ = timed(lambda: schelling.model_configure(size, size, empty_ratio, threshold, depth, race_ratios(empty_ratio)), repeat)
+
+    # Every sample steps a fresh board from the same seed so the rounds compared are the same ones, warmup rounds are
+    # stepped first and not timed, to measure a run once most individuals have settled
+    round_samples = []
+    move_rates = []
+    for _ in range(repeat):
+        schelling = build()
+        for _ in range(warmup):
+            schelling.run_round()
+        number_moves = 0
+        number_rounds = 0
+        start = time.perf_counter()
+        while number_rounds < rounds:
+            number_rounds += 1
+            finished = schelling.run_round()
+            number_moves += schelling.number_moves
+            if finished:
+                break
+        elapsed = time.perf_counter() - start
+        round_samples.append(elapsed / number_rounds)
+        move_rates.append(number_moves / elapsed)
+    schelling.close()
+
+    statistics, _ = timed(schelling.statistics, repeat)
+    neighbourhood, _ = timed(lambda: BigGraph.compute_neighbourhood_numbers(schelling), repeat)
+
+    # tracemalloc slows numpy down, the peak is measured on a run of its own
+    tracemalloc.start()
+    schelling = build()
+    for _ in range(rounds):
+        if schelling.run_round():
+            break
+    schelling.statistics()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    schelling.close()
+
+    return {
+        'engine': engine,
+        'size': size,
+        'depth': depth,
+        'empty_ratio': empty_ratio,
+        'threshold': threshold,
+        'warmup': warmup,
+        'configure_s': configure,
+        'rounds_per_s': 1 / float(np.median(round_samples)),
+        'moves_per_s': float(np.median(move_rates)),
+        'statistics_s': statistics,
+        'neighbourhood_s': neighbourhood,
+        'peak_memory_mb': peak / 2 ** 20
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(), 'system': platform.system()}
+
+
+def case_key(result):
+    return (result['engine'], result['size'], result['depth'], result['empty_ratio'], result['threshold'], result.get('warmup', 0))
+
+
+def compare(results, baseline, tolerance):
+    # Prints the speed of every case against the baseline (above 1 is faster) and returns the cases slower than tolerance
+    previous = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        ratios = {field: result[field] / old[field] for field in RATES if old[field] > 0}
+        ratios.update({field: old[field] / result[field] for field in TIMES if result[field] > 0})
+        slowest = min(ratios, key=ratios.get)
+        print(format_case(result) + "\tspeed " + ", ".join(field + ' x' + str(round(ratio, 2)) for field, ratio in ratios.items()))
+        if ratios[slowest] < 1 - tolerance:
+            regressions.append((result, slowest, ratios[slowest]))
+    return regressions
+
+
+def format_case(result):
+    return result['engine'] + " " + str(result['size']) + "x" + str(result['size']) + " depth " + str(result['depth']) + " empty " + str(result['empty_ratio']) + " threshold " + str(result['threshold']) + (" after " + str(result['warmup']) + " rounds" if result.get('warmup') else "")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Times the model set up, the rounds and the metrics over a grid of parameters')
+    parser.add_argument('-e', '--engines', nargs='+', default=['reference', 'incremental', 'synchronous'], choices=sorted(KERNELS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[50, 100])
+    parser.add_argument('--depths', nargs='+', type=int, default=[1, 2])
+    parser.add_argument('--empty', nargs='+', type=float, default=[0.1, 0.3])
+    parser.add_argument('--thresholds', nargs='+', type=float, default=[0.3, 0.7])
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='rounds stepped per sample')
+    parser.add_argument('-w', '--warmup', type=int, default=0, help='untimed rounds stepped before every sample')
+    parser.add_argument('--repeat', type=int, default=3, help='samples per measure, the median is kept')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='JSON file the results are written to')
+    parser.add_argument('-c', '--compare', help='JSON file of an earlier run, every case is compared to it')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1, help='slowdown against the baseline above which the run fails')
+    args = parser.parse_args()
+
+    results = []
+    for engine, size, depth, empty_ratio, threshold in itertools.product(args.engines, args.sizes, args.depths, args.empty, args.thresholds):
+        result = benchmark_case(engine, size, depth, empty_ratio, threshold, args.rounds, args.repeat, args.seed, args.warmup)
+        results.append(result)
+        print(format_case(result) + "\t" + str(round(result['rounds_per_s'], 2)) + " rounds/s\t" + str(round(result['moves_per_s'])) + " moves/s\t" + str(round(result['peak_memory_mb'], 2)) + " MB")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'environment': environment(), 'results': results}, output, indent=1)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for result, field, ratio in regressions:
+            print("regression: " + format_case(result) + " " + field + " x" + str(round(ratio, 2)))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+from model import MODEL_VERSION
+from results import seed_record
+
+
+# Size of a cache directory above which the least recently used entries are removed
+DEFAULT_CACHE_BYTES = 256 * 2 ** 20
+
+# Share of max_bytes an eviction brings the directory down to, so the next puts don't evict again right away
+EVICT_TO = 0.9
+
+
+# Job entries that don't change its records
+UNCACHED_KEYS = ['profile', 'checkpoint', 'checkpointrounds']
+
+
+def job_key(job):
+    # Hash of everything the records of a job depend on: its parameters, its seeds and the model version
+    fields = {key: value for key, value in job.items() if key not in UNCACHED_KEYS}
+    if 'seed' in fields:
+        fields['seed'] = seed_record(fields['seed'])
+    if 'seeds' in fields:
+        fields['seeds'] = [seed_record(seed) for seed in fields['seeds']]
+    fields['version'] = MODEL_VERSION
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+
+    # Records of finished jobs (a run or an ensemble of graph.py, one point and replicate of sweep.py), one JSON file
+    # per job named after a hash of everything the records depend on, so a changed parameter only misses the jobs it
+    # enters. A hit refreshes the time of its file, and once the directory grows past max_bytes the files with the
+    # oldest times are removed. The directory is scanned once, its entries are then kept in memory from the least to
+    # the most recently used
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.index = OrderedDict((path, size) for _, path, size in sorted(self.entries()))
+        self.size = sum(self.index.values())
+
+
+    def path(self, key):
+        # Entries are spread over 256 subdirectories so none of them gets huge
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+
+    def entries(self):
+        # (time, path, size) of every entry
+        for subdirectory in os.scandir(self.directory):
+            if not subdirectory.is_dir():
+                continue
+            for entry in os.scandir(subdirectory.path):
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    yield stat.st_mtime, entry.path, stat.st_size
+
+
+    def get(self, key):
+        # Records stored for key, None when there are none or the file can't be read
+        path = self.path(key)
+        try:
+            with open(path) as entry:
+                records = json.load(entry)
+                size = os.fstat(entry.fileno()).st_size
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if path not in self.index:
+            # Written by another process since the directory was scanned
+            self.size += size
+        self.index[path] = size
+        self.index.move_to_end(path)
+        return records
+
+
+    def put(self, key, records):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as entry:
+            json.dump(records, entry)
+        os.replace(temporary, path)
+        size = os.path.getsize(path)
+        self.size += size - self.index.pop(path, 0)
+        self.index[path] = size
+        if self.size > self.max_bytes:
+            self.evict()
+
+
+    def evict(self):
+        while self.index and self.size > self.max_bytes * EVICT_TO:
+            path, size = self.index.popitem(last=False)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+
+    def clear(self):
+        for _, path, _ in list(self.entries()):
+            os.remove(path)
+        self.index.clear()
+        self.size = 0
@@ -0,0 +1,68 @@
+import hashlib
+import numpy as np
+
+
+ALL_HAPPY = 'all happy'
+STEADY_STATE = 'steady state'
+CYCLE = 'cycle'
+MAX_ITERATIONS = 'max iterations'
+
+
+def plateau(history, tolerance):
+    # True where the mean of the second half of the window is within tolerance (relative) of the mean of the first half,
+    # history has one row per round and may have a column per replicate
+    history = np.asarray(history, dtype=float)
+    half = history.shape[0] // 2
+    first = history[:half].mean(axis=0)
+    second = history[-half:].mean(axis=0)
+    scale = np.maximum(np.abs(history).mean(axis=0), 1e-9)
+    return np.abs(second - first) <= tolerance * scale
+
+
+class ConvergenceMonitor:
+
+    # Stops a run once the number of unhappy individuals and the neighbourhood ratio have both flattened over the
+    # last window rounds, or when the board comes back to a state already seen in that window
+    def __init__(self, window=100, tolerance=0.01, detect_cycles=True):
+        self.window = window
+        self.tolerance = tolerance
+        self.detect_cycles = detect_cycles
+        self.reset()
+
+
+    def reset(self):
+        self.unhappy_history = []
+        self.ratio_history = []
+        self.states = {}
+
+
+    def get_state(self):
+        return {
+            'unhappy_history': [int(number) for number in self.unhappy_history],
+            'ratio_history': [float(ratio) for ratio in self.ratio_history],
+            'states': [[state.hex(), seen] for state, seen in self.states.items()]
+        }
+
+
+    def set_state(self, state):
+        self.unhappy_history = list(state['unhappy_history'])
+        self.ratio_history = list(state['ratio_history'])
+        self.states = {bytes.fromhex(state): seen for state, seen in state['states']}
+
+
+    def update(self, schelling):
+        self.unhappy_history.append(schelling.number_unhappy)
+        self.ratio_history.append(schelling.neighbourhood_numbers())
+
+        if self.detect_cycles:
+            state = hashlib.blake2b(np.ascontiguousarray(schelling.population).data, digest_size=16).digest()
+            if state in self.states:
+                return CYCLE
+            self.states[state] = len(self.unhappy_history)
+            if len(self.states) > max(self.window, 1):
+                del self.states[next(iter(self.states))]
+
+        if self.window > 0 and len(self.unhappy_history) >= self.window:
+            if plateau(self.unhappy_history[-self.window:], self.tolerance) and plateau(self.ratio_history[-self.window:], self.tolerance):
+                return STEADY_STATE
+        return None
@@ -0,0 +1,65 @@
+import multiprocessing
+import os
+import weakref
+import numpy as np
+
+from multiprocessing import shared_memory
+from neighbourhood import *
+
+
+# Stripes handed out per worker and per round, more than one evens out the load
+STRIPES_PER_WORKER = 4
+
+# Board of the worker process, attached to the shared memory block by the pool initializer
+board = None
+board_memory = None
+
+
+def attach_board(name, shape):
+    global board, board_memory
+    board_memory = shared_memory.SharedMemory(name=name)
+    board = np.ndarray(shape, dtype=POPULATION_DTYPE, buffer=board_memory.buf)
+
+
+def unhappy_stripe(task):
+    top, bottom, neighbourhood, similarity_threshold = task
+    # Ghost-zone exchange: the stripe and neighbour_depth rows on each side are copied from the shared board
+    block, rows = halo_block(board, top, bottom, neighbourhood)
+    mask = unhappy_mask(block, neighbour_counts(block, neighbourhood, halo=True), similarity_threshold)[rows]
+    return np.flatnonzero(mask) + top * board.shape[1]
+
+
+def release(pool, memory):
+    pool.terminate()
+    memory.close()
+    memory.unlink()
+
+
+class DomainDecomposition:
+
+    # A round is run in two phases. In the first one every worker copies its stripe with a halo of neighbour_depth
+    # rows from the shared board, which nobody writes during that phase, and returns the unhappy cells of its
+    # stripe. In the second one the coordinator matches every unhappy individual with the shared pool of empty
+    # cells and writes the moves, so moves that cross stripe boundaries are plain writes to the shared board that
+    # the next round's halo copies see.
+    def __init__(self, population, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.memory = shared_memory.SharedMemory(create=True, size=max(population.nbytes, 1))
+        self.population = np.ndarray(population.shape, dtype=POPULATION_DTYPE, buffer=self.memory.buf)
+        self.population[...] = population
+
+        self.pool = multiprocessing.Pool(self.workers, initializer=attach_board, initargs=(self.memory.name, population.shape))
+        self.finalizer = weakref.finalize(self, release, self.pool, self.memory)
+
+        height = population.shape[0]
+        bounds = np.linspace(0, height, min(height, self.workers * STRIPES_PER_WORKER) + 1).astype(int)
+        self.stripes = [(int(top), int(bottom)) for top, bottom in zip(bounds[:-1], bounds[1:]) if bottom > top]
+
+
+    def unhappy(self, neighbourhood, similarity_threshold):
+        tasks = [(top, bottom, neighbourhood, similarity_threshold) for top, bottom in self.stripes]
+        return np.concatenate(self.pool.map(unhappy_stripe, tasks))
+
+
+    def close(self):
+        self.finalizer()
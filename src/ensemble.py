@@ -0,0 +1,118 @@
+import numpy as np
+
+from neighbourhood import *
+from metrics import mean_same_race_ratio
+from convergence import *
+
+
+class Ensemble:
+
+    # Steps K replicates held in one (K, height, width) array with the synchronous rule, replicates
+    # that have converged are masked off and no longer computed
+    def __init__(self, population, similarity_threshold, neighbour_depth, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.model_configure(population, similarity_threshold, neighbour_depth)
+
+
+    def model_configure(self, population, similarity_threshold, neighbour_depth):
+        self.population = np.array(population)
+        self.replicates, self.height, self.width = self.population.shape
+        self.similarity_threshold = similarity_threshold
+        # neighbour_depth is an int depth of a Moore neighbourhood with open borders, or a Neighbourhood
+        self.neighbourhood = as_neighbourhood(neighbour_depth)
+        self.neighbourhood.check_board(self.height, self.width)
+        self.neighbour_depth = self.neighbourhood.depth
+
+        self.active = np.ones(self.replicates, dtype=bool)
+        self.number_iterations = np.zeros(self.replicates, dtype=np.int64)
+        self.number_unhappy = np.zeros(self.replicates, dtype=np.int64)
+        self.stop_reasons = [None] * self.replicates
+        self.unhappy_history = [[] for _ in range(self.replicates)]
+
+
+    def run_round(self):
+        replicates = np.flatnonzero(self.active)
+        if replicates.size == 0:
+            return True
+
+        population = self.population[replicates]
+        counts = neighbour_counts(population, self.neighbourhood)
+        unhappy = unhappy_mask(population, counts, self.similarity_threshold).reshape(replicates.size, -1)
+        cells = population.reshape(replicates.size, -1)
+        empty = cells == 0
+
+        number_unhappy = unhappy.sum(axis=1)
+        self.number_unhappy[replicates] = number_unhappy
+        for replicate, number in zip(replicates, number_unhappy.tolist()):
+            self.unhappy_history[replicate].append(number)
+        number_moves = np.minimum(number_unhappy, empty.sum(axis=1))
+
+        # Random keys rank the unhappy and the empty cells of each replicate, the k-th mover goes to the k-th empty cell
+        movers = np.argsort(np.where(unhappy, self.rng.random(unhappy.shape), 2.0), axis=1)
+        destinations = np.argsort(np.where(empty, self.rng.random(empty.shape), 2.0), axis=1)
+        moving = np.arange(cells.shape[1]) < number_moves[:, None]
+        rows = np.nonzero(moving)[0]
+        movers = movers[moving]
+        destinations = destinations[moving]
+
+        cells[rows, destinations] = cells[rows, movers]
+        cells[rows, movers] = 0
+        self.population[replicates] = population
+
+        self.stop(replicates[number_unhappy == 0], ALL_HAPPY)
+        return not self.active.any()
+
+
+    def stop(self, replicates, reason):
+        for replicate in replicates[self.active[replicates]]:
+            self.stop_reasons[replicate] = reason
+        self.active[replicates] = False
+
+
+    def run(self, max_iterations, window=0, tolerance=0.01):
+        # Same stopping rule and count of iterations as Schelling.run, applied to every replicate on its own: the round
+        # that ends a run isn't counted. window=0 disables the steady state detection
+        unhappy_history = []
+        ratio_history = []
+        while not self.run_round():
+            if window > 0:
+                unhappy_history.append(self.number_unhappy.copy())
+                ratio_history.append(self.neighbourhood_numbers())
+                if len(unhappy_history) >= window:
+                    steady = plateau(unhappy_history[-window:], tolerance) & plateau(ratio_history[-window:], tolerance)
+                    self.stop(np.flatnonzero(steady), STEADY_STATE)
+
+            self.stop(np.flatnonzero(self.number_iterations >= max_iterations), MAX_ITERATIONS)
+            if not self.active.any():
+                break
+            self.number_iterations[self.active] += 1
+
+
+    def neighbourhood_numbers(self):
+        counts = neighbour_counts(self.population, self.neighbourhood)
+        return mean_same_race_ratio(self.population, counts, self.neighbourhood)
+
+
+def check_rounds(width=12, height=10, similarity_threshold=0.9, max_iterations=5, replicates=3, seed=0):
+    # Runs that hit max_iterations report the same rounds and stop reason as Schelling.run, returns the replicates
+    # that differ
+    from model import Schelling, random_population
+    rng = np.random.default_rng(seed)
+    populations = [random_population(rng, width, height, 0.1) for _ in range(replicates)]
+    ensemble = Ensemble(populations, similarity_threshold, 1, seed=seed)
+    ensemble.run(max_iterations)
+
+    mismatches = []
+    for replicate, population in enumerate(populations):
+        schelling = Schelling(width, height, 0.1, similarity_threshold, 1, engine='synchronous', seed=seed, population=population)
+        rounds, stop_reason = schelling.run(max_iterations)
+        if (rounds, stop_reason) != (ensemble.number_iterations[replicate], ensemble.stop_reasons[replicate]) or stop_reason != MAX_ITERATIONS:
+            mismatches.append(replicate)
+    return mismatches
+
+
+if __name__ == "__main__":
+    import sys
+    mismatches = check_rounds()
+    print("rounds at max_iterations: " + ("replicates " + ", ".join(str(replicate) for replicate in mismatches) + " differ" if mismatches else "ok"))
+    sys.exit(1 if mismatches else 0)
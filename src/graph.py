@@ -1,21 +1,152 @@
-from schelling import *
+from model import Schelling, random_population, seed_sequence
+from convergence import ConvergenceMonitor
+from ensemble import Ensemble
+from metrics import race_adjacency
+from neighbourhood import Neighbourhood, neighbour_counts
+from results import *
+from cache import ResultCache, job_key
+from profiler import Profiler
+import argparse
+from storage import load_run_state, save_run_state, read_metadata, write_metadata, metadata_path
 import configparser
-import sys
-import random
+import functools
+import json
+import multiprocessing
+import os
+import shutil
 import numpy as np
-import matplotlib.pyplot as plt
+
+
+def random_races_ratios(rng, emptyratio, numberraces):
+    races = [0, 0, 0, 0, 0]
+    ratio_total = emptyratio
+    for i in range(numberraces):
+        if i == numberraces - 1:
+            races[i] = round(1 - ratio_total, 2)
+        else:
+            races[i] = round(rng.uniform(0, 1 - ratio_total), 2)
+        ratio_total = ratio_total + races[i]
+    return races
+
+
+def job_ratios(rng, job):
+    if job['random']:
+        emptyratio = round(rng.uniform(0, 1), 2)
+        return emptyratio, random_races_ratios(rng, emptyratio, job['numberraces'])
+    return job['emptyratio'], job['races']
+
+
+def run_simulation(job):
+    # Runs one (threshold, replicate) simulation on its own seeded Schelling, can be called from a worker process
+    rng = np.random.default_rng(job['seed'])
+    emptyratio, races = job_ratios(rng, job)
+
+    profiler = Profiler() if job['profile'] else None
+    neighbourhood = Neighbourhood(**job['neighbourhood'])
+    schelling = Schelling(job['width'], job['height'], emptyratio, job['threshold'] / 100, neighbourhood, races, seed=rng, profiler=profiler)
+    monitor = ConvergenceMonitor(job['convergencewindow'], job['convergencetolerance'])
+
+    # A run interrupted in the middle carries on from its last saved round
+    path = job.get('checkpoint')
+    resume = False
+    on_round = None
+    if path is not None:
+        if os.path.exists(path):
+            state, monitor_state = load_run_state(path)
+            schelling.set_state(state)
+            monitor.set_state(monitor_state)
+            resume = True
+        on_round = functools.partial(checkpoint_run, path, job['checkpointrounds'])
+
+    rounds, stop_reason = schelling.run(job['maxiterations'], monitor, resume, on_round)
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+    record = {
+        'threshold': job['threshold'],
+        'replicate': job['replicate'],
+        'seed': seed_record(job['seed']),
+        'rounds': rounds,
+        'stop_reason': stop_reason,
+        'unhappy': schelling.unhappy_history,
+        'neighbourhood_ratio': BigGraph.compute_neighbourhood_numbers(schelling),
+        'race_adjacency': schelling.race_adjacency().tolist()
+    }
+    if profiler is not None:
+        record['profile'] = profiler.report()
+    return record
+
+
+def checkpoint_run(path, every, schelling, monitor):
+    if schelling.round_number % every == 0:
+        save_run_state(path, schelling.get_state(), monitor.get_state())
+
+
+def run_ensemble(job):
+    # Runs a whole threshold column at once, every replicate starts from the board its own seed would give
+    populations = []
+    for seed in job['seeds']:
+        rng = np.random.default_rng(seed)
+        emptyratio, races = job_ratios(rng, job)
+        populations.append(random_population(rng, job['width'], job['height'], emptyratio, races))
+
+    # The moves use a stream spawned below the first replicate's seed
+    first = job['seeds'][0]
+    moves_seed = np.random.SeedSequence(first.entropy, spawn_key=first.spawn_key + (0,))
+    ensemble = Ensemble(populations, job['threshold'] / 100, Neighbourhood(**job['neighbourhood']), seed=moves_seed)
+    ensemble.run(job['maxiterations'], job['convergencewindow'], job['convergencetolerance'])
+
+    counts = neighbour_counts(ensemble.population, ensemble.neighbourhood)
+    ratios = ensemble.neighbourhood_numbers()
+    records = []
+    for replicate, seed in enumerate(job['seeds']):
+        records.append({
+            'threshold': job['threshold'],
+            'replicate': replicate,
+            'seed': seed_record(seed),
+            'rounds': int(ensemble.number_iterations[replicate]),
+            'stop_reason': ensemble.stop_reasons[replicate],
+            'unhappy': ensemble.unhappy_history[replicate],
+            'neighbourhood_ratio': float(ratios[replicate]),
+            'race_adjacency': race_adjacency(ensemble.population[replicate], counts[replicate]).tolist()
+        })
+    return records
+
 
 class BigGraph:
 
-    def __init__(self, confFile):
+    def __init__(self, confFile, workers=None, seed=None, fresh=False, profile=None, use_cache=True):
         self.threshold = 1
         
         self.read_properties(confFile)
+        if profile is not None:
+            self.profile = profile
+        # Phase times and counts of every run added up, None when the sweep isn't profiled
+        self.profiler = Profiler() if self.profile else None
+        if workers is not None:
+            self.workers = workers
+        if seed is not None:
+            self.seed = seed
+        if self.workers <= 0:
+            self.workers = os.cpu_count()
         
-        self.values = [[0.0 for y in range(self.simulations)] for x in range(100)]
+        # (threshold, replicate, metric) array of the finished runs, the ones already in the output file are
+        # loaded and a restart of the same sweep skips them
+        self.cube = ResultsCube(self.simulations)
+        self.resumed = False
+        self.checkpoints = None
+        if self.output and not fresh:
+            self.load_results()
 
+        # Records of earlier runs of any sweep, keyed by everything they depend on, None when bypassed. A sweep
+        # without a seed draws one and could never hit it
+        self.cache = None
+        if self.cachedir and use_cache and self.seed is not None:
+            self.cache = ResultCache(self.cachedir, self.cachesize * 2 ** 20)
 
-        self.schelling = Schelling(self.width, self.height, self.emptyratio, self.threshold, self.ndepth, self.races)
+        # One independent child stream per (threshold, replicate) so the results don't depend on the number of workers
+        self.seed_sequence = seed_sequence(self.seed)
+        self.seeds = self.seed_sequence.spawn(100 * self.simulations)
     
 
     def read_properties(self, confFile):
@@ -28,6 +159,8 @@ class BigGraph:
         self.width = config['DEFAULT'].getint('popwidth')
         self.height = config['DEFAULT'].getint('popheight')
         self.ndepth = config['DEFAULT'].getint('ndepth')
+        self.neighbourhood = Neighbourhood(self.ndepth, config['DEFAULT'].get('neighbourhood', 'moore'), config['DEFAULT'].get('boundary', 'open'),
+                                           config['DEFAULT'].getfloat('radius', None))
         self.random = config['DEFAULT'].getboolean('random')
         self.numberraces = config['DEFAULT'].getint('numberraces')
         self.emptyratio = config['DEFAULT'].getfloat('emptyratio')
@@ -38,117 +171,301 @@ class BigGraph:
             config['DEFAULT'].getfloat('rdratio'),
             config['DEFAULT'].getfloat('reratio')
         ]
+        self.workers = config['DEFAULT'].getint('nworkers', 1)
+        self.ensemble = config['DEFAULT'].getboolean('ensemble', False)
+        self.convergencewindow = config['DEFAULT'].getint('convergencewindow', 100)
+        self.convergencetolerance = config['DEFAULT'].getfloat('convergencetolerance', 0.01)
+        self.seed = config['DEFAULT'].getint('seed', None)
+        # A relative output file is next to the config file, like the cache
+        self.output = config['DEFAULT'].get('output', None)
+        if self.output:
+            self.output = os.path.join(os.path.dirname(os.path.abspath(confFile)), self.output)
+        self.outputbuffer = config['DEFAULT'].getint('outputbuffer', 32)
+        self.checkpointrounds = config['DEFAULT'].getint('checkpointrounds', 0)
+        self.adaptive = config['DEFAULT'].getboolean('adaptive', False)
+        self.profile = config['DEFAULT'].getboolean('profile', False)
+        self.adaptivestep = config['DEFAULT'].getint('adaptivestep', 10)
+        self.minsimulations = config['DEFAULT'].getint('minsimulations', 3)
+        self.citarget = config['DEFAULT'].getfloat('citarget', 0.02)
+        self.refinedelta = config['DEFAULT'].getfloat('refinedelta', 0.05)
+        self.commonrandom = config['DEFAULT'].getboolean('commonrandom', False)
+        # An empty cache disables it, a relative one is next to the config file
+        self.cachedir = config['DEFAULT'].get('cache', '.schelling-cache')
+        if self.cachedir:
+            self.cachedir = os.path.join(os.path.dirname(os.path.abspath(confFile)), self.cachedir)
+        self.cachesize = config['DEFAULT'].getint('cachesize', 256)
 
         print(self.maxiterations, self.width, self.height, self.ndepth, self.threshold, self.emptyratio, self.races)
 
 
-    def compute(self):
-        while self.threshold <= 100:
-            number_of_simulation_in_threshold = 0
+    def sweep_parameters(self):
+        # What has to be the same for the records of an output file to belong to this sweep
+        return {
+            'simulations': self.simulations,
+            'maxiterations': self.maxiterations,
+            'width': self.width,
+            'height': self.height,
+            'neighbourhood': self.neighbourhood.describe(),
+            'random': self.random,
+            'numberraces': self.numberraces,
+            'emptyratio': self.emptyratio,
+            'races': self.races,
+            'ensemble': self.ensemble,
+            'adaptive': self.adaptive,
+            'commonrandom': self.commonrandom,
+            'convergencewindow': self.convergencewindow,
+            'convergencetolerance': self.convergencetolerance
+        }
 
-            while number_of_simulation_in_threshold < self.simulations:
-                number_iterations = 0
-                eff_threshold = self.threshold / 100
-                self.schelling.model_configure(self.width, self.height, self.emptyratio, eff_threshold, self.ndepth, self.races)
+    def load_results(self):
+        if not os.path.exists(metadata_path(self.output)):
+            return
+        metadata = read_metadata(self.output)
+        if metadata['parameters'] != self.sweep_parameters() or self.seed not in (None, metadata['seed']):
+            raise ValueError(self.output + ' holds the results of another sweep, remove it or start over with --fresh')
 
-                while not self.schelling.run_round() and number_iterations < self.maxiterations:
-                    number_iterations += 1
-                
-                self.values[self.threshold - 1][number_of_simulation_in_threshold] = self.compute_neighbourhood_numbers()
-                number_of_simulation_in_threshold += 1
+        # Without a seed in the config the sweep had drawn one, the restart has to reuse it
+        self.seed = metadata['seed']
+        self.resumed = True
+        for record in read_results(self.output):
+            self.cube.add(record)
 
-            print(self.threshold)
-            self.threshold += 1
+    def start_output(self):
+        if self.checkpointrounds > 0 and not self.ensemble:
+            self.checkpoints = self.output + '.runs'
+            # Runs saved by another sweep must not be picked up
+            if not self.resumed:
+                shutil.rmtree(self.checkpoints, ignore_errors=True)
+            os.makedirs(self.checkpoints, exist_ok=True)
+        if not self.resumed:
+            open(self.output, 'w').close()
+            write_metadata(self.output, {'parameters': self.sweep_parameters(), 'seed': self.seed_sequence.entropy})
+            self.resumed = True
 
-        return self.values
+
+    def compute(self):
+        return self.sweep(False)
 
     def compute_random(self):
-        while self.threshold <= 100:
-            number_of_simulation_in_threshold = 0
-
-            while number_of_simulation_in_threshold < self.simulations:
-                number_iterations = 0
-                eff_threshold = self.threshold / 100
-                self.emptyratio = round(random.uniform(0, 1), 2)
-                ratio_total = self.emptyratio
-                races = [0, 0, 0, 0, 0]
-                for i in range(self.numberraces):
-                    if i == self.numberraces - 1:
-                        races[i] = round(1 - ratio_total, 2)
-                    else:
-                        races[i] = round(random.uniform(0, 1 - ratio_total), 2)
-                    ratio_total = ratio_total + races[i]
-                self.races = races
-                self.schelling.model_configure(self.width, self.height, self.emptyratio, eff_threshold, self.ndepth, self.races)
-
-                while not self.schelling.run_round() and number_iterations < self.maxiterations:
-                    number_iterations += 1
-                
-                self.values[self.threshold - 1][number_of_simulation_in_threshold] = self.compute_neighbourhood_numbers()
-                number_of_simulation_in_threshold += 1
-
-            print(self.threshold)
-            self.threshold += 1
+        return self.sweep(True)
+
+
+    def job(self, threshold, random_ratios):
+        return {
+            'threshold': threshold,
+            'width': self.width,
+            'height': self.height,
+            'emptyratio': self.emptyratio,
+            'races': self.races,
+            'random': random_ratios,
+            'numberraces': self.numberraces,
+            'neighbourhood': self.neighbourhood.describe(),
+            'maxiterations': self.maxiterations,
+            'convergencewindow': self.convergencewindow,
+            'convergencetolerance': self.convergencetolerance,
+            'profile': self.profile
+        }
 
+    def jobs(self, random_ratios):
+        for threshold in range(self.threshold, 101):
+            first = self.seed_index(threshold, 0)
+            if self.ensemble:
+                if all(self.cube.finished(threshold, replicate) for replicate in range(self.simulations)):
+                    continue
+                job = self.job(threshold, random_ratios)
+                job['seeds'] = self.seeds[first:first + self.simulations]
+                yield job
+                continue
+            for replicate in range(self.simulations):
+                if not self.cube.finished(threshold, replicate):
+                    yield self.replicate_job(threshold, replicate, random_ratios)
+
+    def seed_index(self, threshold, replicate):
+        # With common random numbers every threshold reuses the seeds of the first one, so replicate r starts from
+        # the same board and draws the same moves at every threshold and the curve compares like with like
+        if self.commonrandom:
+            return replicate
+        return (threshold - 1) * self.simulations + replicate
+
+    def replicate_job(self, threshold, replicate, random_ratios):
+        # The seed only depends on (threshold, replicate), an adaptive sweep runs a subset of the runs of the full grid
+        job = self.job(threshold, random_ratios)
+        job['replicate'] = replicate
+        job['seed'] = self.seeds[self.seed_index(threshold, replicate)]
+        if self.checkpoints is not None:
+            job['checkpoint'] = os.path.join(self.checkpoints, str(threshold) + '_' + str(replicate) + '.npz')
+            job['checkpointrounds'] = self.checkpointrounds
+        return job
+
+    def sweep(self, random_ratios):
+        if self.output:
+            self.start_output()
+
+        # Every finished run is appended to the output file as soon as it comes back, not at the end of the sweep
+        sink = ResultsSink(self.output, self.outputbuffer, append=True) if self.output else None
+        pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+        try:
+            if self.adaptive:
+                self.adaptive_sweep(random_ratios, pool, sink)
+            else:
+                self.run_jobs(list(self.jobs(random_ratios)), pool, sink)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if sink is not None:
+                sink.close()
+
+        self.threshold = 101
         return self.values
 
+    def run_jobs(self, jobs, pool, sink=None):
+        if self.cache is not None:
+            jobs = self.cached_jobs(jobs, sink)
+            if not jobs:
+                return
+        function = run_ensemble if self.ensemble and not self.adaptive else run_simulation
+        if pool is not None:
+            # imap keeps the job order, so the values matrix is filled the same way as a serial run
+            results = pool.imap(function, jobs, chunksize=max(1, len(jobs) // (self.workers * 16)))
+        else:
+            results = map(function, jobs)
+        if self.cache is not None:
+            results = self.cache_results(jobs, results)
+        self.collect(jobs, results, sink)
+
+
+    def cached_jobs(self, jobs, sink=None):
+        # Collects the jobs found in the cache and returns the others
+        missing = []
+        for job in jobs:
+            records = self.cache.get(job_key(job))
+            if records is None:
+                missing.append(job)
+            else:
+                self.collect([job], [records], sink)
+        if len(missing) < len(jobs):
+            print(len(jobs) - len(missing), 'of', len(jobs), 'jobs reused from the cache')
+        return missing
+
+
+    def cache_results(self, jobs, results):
+        for job, result in zip(jobs, results):
+            records = result if isinstance(result, list) else [result]
+            # The profile of a run describes that run only, a later hit doesn't repeat its time
+            self.cache.put(job_key(job), [{key: value for key, value in record.items() if key != 'profile'} for record in records])
+            yield result
+
+
+    def adaptive_sweep(self, random_ratios, pool, sink=None):
+        # Starts from a coarse grid of thresholds with a few replicates each, then adds replicates where the confidence
+        # interval of the mean ratio is still wider than citarget and thresholds halfway between two neighbours whose
+        # mean or standard deviation differ by more than refinedelta, until neither adds anything
+        thresholds = set(range(1, 101, self.adaptivestep)) | {100}
+        thresholds |= set((np.flatnonzero(self.cube.counts()) + 1).tolist())
+        minimum = max(2, min(self.minsimulations, self.simulations))
+        while True:
+            statistics = self.cube.statistics(percentiles=())
+            rows = {threshold: row for row, threshold in enumerate(statistics['threshold'].tolist())}
+            number = np.zeros(101, dtype=np.int64)
+            number[statistics['threshold']] = statistics['count']
 
+            jobs = []
+            for threshold in sorted(thresholds):
+                if number[threshold] < minimum:
+                    wanted = minimum
+                elif number[threshold] < self.simulations and statistics['high'][rows[threshold]] - statistics['mean'][rows[threshold]] > self.citarget:
+                    wanted = min(2 * number[threshold], self.simulations)
+                else:
+                    continue
+                missing = [replicate for replicate in range(self.simulations) if not self.cube.finished(threshold, replicate)]
+                jobs += [self.replicate_job(threshold, replicate, random_ratios) for replicate in missing[:wanted - number[threshold]]]
 
-    def compute_neighbourhood_numbers(self):
-        neigh_sum = 0
-        number_of_ind = 0
-        for (row, col), value in np.ndenumerate(self.schelling.population):
-            if self.schelling.get_race(row,col) != 0:
-                neigh_sum += self.schelling.get_ratio_of_individuals_same_race_in_neighbourhood(row, col)
-                number_of_ind += 1
-        if number_of_ind == 0:
-            return 1
-        return neigh_sum / number_of_ind
+            refined = set()
+            ordered = sorted(thresholds)
+            for low, high in zip(ordered, ordered[1:]):
+                if high - low < 2 or number[low] < minimum or number[high] < minimum:
+                    continue
+                change = abs(statistics['mean'][rows[high]] - statistics['mean'][rows[low]])
+                spread = abs(statistics['std'][rows[high]] - statistics['std'][rows[low]])
+                if change > self.refinedelta or spread > self.refinedelta:
+                    refined.add((low + high) // 2)
+
+            if not jobs and not refined:
+                break
+            thresholds |= refined
+            if jobs:
+                print(len(jobs), 'runs on', len({job['threshold'] for job in jobs}), 'thresholds')
+                self.run_jobs(jobs, pool, sink)
+
+    @property
+    def values(self):
+        # (threshold, replicate) array of the final neighbourhood ratio, NaN where the run hasn't finished
+        return self.cube.metric('neighbourhood_ratio')
+
+    def collect(self, jobs, results, sink=None):
+        for job, result in zip(jobs, results):
+            records = result if isinstance(result, list) else [result]
+            for record in records:
+                if self.cube.finished(record['threshold'], record['replicate']):
+                    continue
+                self.cube.add(record)
+                if self.profiler is not None and 'profile' in record:
+                    self.profiler.merge(record['profile'])
+                if sink is not None:
+                    sink.write(record)
+            if records[-1]['replicate'] == self.simulations - 1 and not self.adaptive:
+                print(job['threshold'])
+
+
+    @staticmethod
+    def compute_neighbourhood_numbers(schelling):
+        return schelling.neighbourhood_numbers()
 
 
     def compute_average(self, matrix):
-        result = [0.0 for y in range(100)]
-        for i in range(len(matrix)):
-            for j in range(len(matrix[0])):
-                result[i] += matrix[i][j]
-            result[i] /= self.simulations
-        return result
+        return np.asarray(matrix).mean(axis=1)
         
 
     def get_min(self, matrix):
-        result = [0.0 for y in range(100)]
-        for i in range(len(matrix)):
-            for j in range(len(matrix[0])):
-                result[i] = min(matrix[i])
-        return result
+        return np.asarray(matrix).min(axis=1)
     
     def get_max(self, matrix):
-        result = [0.0 for y in range(100)]
-        for i in range(len(matrix)):
-            for j in range(len(matrix[0])):
-                result[i] = max(matrix[i])
-        return result
-
-if len(sys.argv) != 1:
-    path = sys.argv[1]
-    bg = BigGraph(path)
-    if not bg.random:
-        values = bg.compute()
-    else: 
-        values = bg.compute_random()
-
-    min_values = bg.get_min(values)
-    average_values = bg.compute_average(values)
-    max_values = bg.get_max(values)
-
-    x_coords = [x / 100 for x in range(1, 101)]
-    plt.plot(x_coords, min_values, label='Min')
-    plt.plot(x_coords, average_values, label='Average')
-    plt.plot(x_coords, max_values, label='Max')
+        return np.asarray(matrix).max(axis=1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage='python graph.py configFilePath [--workers N] [--seed S] [--plot] [--fresh] [--profile] [--no-cache]')
+    parser.add_argument('config')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes, 0 uses every core')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='seed of the sweep, overrides the one in the config file')
+    parser.add_argument('-p', '--plot', action='store_true', help='only plot what the output file already holds, works on a sweep still running')
+    parser.add_argument('--profile', action='store_true', default=None, help='time the phases of every run and print the totals at the end')
+    parser.add_argument('-f', '--fresh', action='store_true', help='start the sweep over instead of skipping the runs already in the output file')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='run every simulation, without reading or filling the result cache')
+    args = parser.parse_args()
+
+    bg = BigGraph(args.config, args.workers, args.seed, args.fresh, args.profile, args.cache)
+    if args.plot and not bg.output:
+        parser.error('--plot needs output set in the config file')
+    if not args.plot:
+        if not bg.random:
+            bg.compute()
+        else:
+            bg.compute_random()
+        if bg.profiler is not None:
+            print(bg.profiler.summary())
+
+    cube = ResultsCube.from_records(read_results(bg.output)) if args.plot else bg.cube
+    statistics = cube.statistics()
+    x_coords = statistics['threshold'] / 100
+
+    import matplotlib.pyplot as plt
+
+    plt.fill_between(x_coords, statistics['p10'], statistics['p90'], alpha=0.15, label='10-90th percentile')
+    plt.fill_between(x_coords, statistics['low'], statistics['high'], alpha=0.3, label='95% confidence of the average')
+    plt.plot(x_coords, statistics['min'], label='Min')
+    plt.plot(x_coords, statistics['mean'], label='Average')
+    plt.plot(x_coords, statistics['max'], label='Max')
     plt.xlabel('Similarity Threshold')
     plt.ylabel('Number of neighbours of the same color')
     plt.legend()
     plt.show()
-
-else:
-    print('Usage: python graph.py configFilePath')
@@ -0,0 +1,54 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# Modules that must never be loaded by a headless import
+GUI_MODULES = ['tkinter', 'matplotlib']
+
+MEASURE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {gui} if m in sys.modules]}}))
+'''
+
+
+def measure(module, repeat):
+    # Every sample runs in a fresh interpreter, the import time of a worker process starting from scratch
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    code = MEASURE.format(module=module, gui=GUI_MODULES)
+    samples = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], cwd=source_dir, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        samples.append(result['elapsed'])
+        loaded = result['loaded']
+    samples.sort()
+    return samples[len(samples) // 2], loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Checks the import time of the headless modules against a budget')
+    parser.add_argument('modules', nargs='*', default=['model', 'graph'])
+    parser.add_argument('-b', '--budget', type=float, default=0.3, help='budget in seconds for each module')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        median, loaded = measure(module, args.repeat)
+        status = 'ok'
+        if median > args.budget:
+            status = 'over budget'
+            failed = True
+        if loaded:
+            status = 'loads ' + ', '.join(loaded)
+            failed = True
+        print(module + ":\t" + str(round(median * 1000, 1)) + " ms\t(budget " + str(round(args.budget * 1000)) + " ms)\t" + status)
+
+    sys.exit(1 if failed else 0)
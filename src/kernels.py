@@ -0,0 +1,178 @@
+import importlib.util
+import numpy as np
+
+from neighbourhood import *
+
+
+# Step kernels by name. A kernel runs one round on a Schelling instance and returns True when nobody was unhappy.
+# Kernels with the same semantics must give the same boards for the same seed.
+KERNELS = {}
+
+
+class Kernel:
+
+    def __init__(self, name, step, semantics, free_cells=True, counts=True, prepare=None, setup=None):
+        self.name = name
+        self.step = step
+        self.semantics = semantics
+        # whether the model keeps its free-cell index and its neighbour counts for this kernel
+        self.free_cells = free_cells
+        self.counts = counts
+        # prepare(schelling, population) may replace a new board before it's installed, setup(schelling) runs after
+        self.prepare = prepare
+        self.setup = setup
+
+
+def register_kernel(name, semantics, free_cells=True, counts=True, prepare=None, setup=None):
+    def register(step):
+        KERNELS[name] = Kernel(name, step, semantics, free_cells, counts, prepare, setup)
+        return step
+    return register
+
+
+def get_kernel(name):
+    if name not in KERNELS:
+        raise ValueError("Unknown engine '" + str(name) + "', expected one of " + ", ".join(KERNELS))
+    return KERNELS[name]
+
+
+def sequential_scan(cells, width, counts, empty_cells, empty_slot, draws, position, start, similarity_threshold, offsets, torus):
+    # The reference round written as plain loops over flat arrays, so a JIT compiler can take it as is. Happiness
+    # comes from the maintained counts, which are patched on every move like Schelling.move does. Stops when a draw is
+    # needed and the buffer is empty, returning the cell to resume at, the new buffer position and the unhappy count.
+    # offsets are the (row, column) offsets of the neighbourhood, torus wraps them around the borders instead of
+    # dropping the ones that fall outside.
+    height = cells.size // width
+    number_empty = empty_cells.size
+    number_unhappy = 0
+    for index in range(start, cells.size):
+        race = cells[index]
+        if race == 0:
+            continue
+        row = index // width
+        col = index % width
+
+        number_occupied = 0
+        for value in range(1, 6):
+            number_occupied += int(counts[value, row, col])
+        number_occupied -= 1
+        if number_occupied <= 0:
+            continue
+        number_similar = int(counts[race, row, col]) - 1
+        if number_similar / number_occupied >= similarity_threshold:
+            continue
+
+        if number_empty == 0:
+            number_unhappy += 1
+            continue
+        if position == draws.size:
+            return index, position, number_unhappy
+        number_unhappy += 1
+
+        slot = min(int(draws[position] * number_empty), number_empty - 1)
+        position += 1
+        destination = empty_cells[slot]
+        cells[destination] = race
+        cells[index] = 0
+        empty_cells[slot] = index
+        empty_slot[index] = slot
+        empty_slot[destination] = -1
+
+        destination_row = destination // width
+        destination_col = destination % width
+        for k in range(offsets.shape[0]):
+            x = row + offsets[k, 0]
+            y = col + offsets[k, 1]
+            if torus:
+                x %= height
+                y %= width
+            if 0 <= x < height and 0 <= y < width:
+                counts[race, x, y] -= 1
+                counts[0, x, y] += 1
+            x = destination_row + offsets[k, 0]
+            y = destination_col + offsets[k, 1]
+            if torus:
+                x %= height
+                y %= width
+            if 0 <= x < height and 0 <= y < width:
+                counts[race, x, y] += 1
+                counts[0, x, y] -= 1
+    return cells.size, position, number_unhappy
+
+
+def scan_round(schelling, scan=sequential_scan):
+    schelling.reserve_draws(np.count_nonzero(schelling.unhappy_mask()))
+    cells = schelling.population.reshape(-1)
+    start = 0
+    number_unhappy = 0
+    while True:
+        start, schelling.draw_position, unhappy = scan(cells, schelling.width, schelling.counts, schelling.empty_cells, schelling.empty_slot,
+                                                       schelling.draws, schelling.draw_position, start, schelling.similarity_threshold,
+                                                       schelling.neighbourhood.offsets, schelling.neighbourhood.boundary == 'torus')
+        number_unhappy += unhappy
+        if start == cells.size:
+            break
+        schelling.reserve_draws(1)
+
+    schelling.number_unhappy = number_unhappy
+    # The scan moves every unhappy individual as long as there is a free cell
+    schelling.number_moves = number_unhappy if schelling.empty_cells.size > 0 else 0
+    if number_unhappy == 0:
+        return True
+    return False
+
+
+# The compiled kernel is only registered when numba happens to be installed, and numba is only imported
+# (and the scan compiled) the first time the kernel runs
+compiled_scan = None
+
+
+def jit_round(schelling):
+    global compiled_scan
+    if compiled_scan is None:
+        import numba
+        compiled_scan = numba.njit(cache=True)(sequential_scan)
+    return scan_round(schelling, compiled_scan)
+
+
+if importlib.util.find_spec('numba') is not None:
+    register_kernel('jit', 'sequential')(jit_round)
+
+
+def check_conformance(width=30, height=30, empty_ratio=0.2, similarity_threshold=0.6, neighbour_depth=1, races_ratios=None, rounds=20, seed=0):
+    # Runs every kernel from the same seed and compares the boards round by round with the first kernel of the
+    # same semantics, returns the list of kernels that diverged
+    from model import Schelling
+
+    mismatches = []
+    groups = {}
+    for name, kernel in KERNELS.items():
+        groups.setdefault(kernel.semantics, []).append(name)
+
+    for semantics, names in groups.items():
+        models = [Schelling(width, height, empty_ratio, similarity_threshold, neighbour_depth, races_ratios, engine=name, seed=seed, workers=2) for name in names]
+        for number_round in range(rounds):
+            results = [model.run_round() for model in models]
+            for name, model, result in zip(names[1:], models[1:], results[1:]):
+                if name not in mismatches and (result != results[0] or not np.array_equal(model.population, models[0].population)):
+                    mismatches.append(name)
+        for model in models:
+            model.close()
+    return mismatches
+
+
+if __name__ == "__main__":
+    import sys
+    # the registry filled by the model lives in the imported module, not in this script
+    import kernels
+
+    # Non-square boards catch a row and column mix-up, the tori the wrapped patches
+    neighbourhoods = [kernels.Neighbourhood(1), kernels.Neighbourhood(2), kernels.Neighbourhood(2, 'von_neumann'),
+                      kernels.Neighbourhood(1, boundary='torus'), kernels.Neighbourhood(shape='circle', boundary='torus', radius=2.5)]
+    failed = False
+    for neighbourhood in neighbourhoods:
+        for threshold in (0.3, 0.6, 0.9):
+            mismatches = kernels.check_conformance(width=30, height=20, similarity_threshold=threshold, neighbour_depth=neighbourhood)
+            print(repr(neighbourhood) + ", threshold " + str(threshold) + ": " + (", ".join(mismatches) + " diverged" if mismatches else "ok"))
+            failed = failed or bool(mismatches)
+    sys.exit(1 if failed else 0)
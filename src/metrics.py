@@ -0,0 +1,43 @@
+import numpy as np
+
+from neighbourhood import *
+
+
+def same_race_ratio_sums(population, counts, neighbourhood_size):
+    # Sum over the individuals of the ratio of cells of their race in the rest of their neighbourhood, and the
+    # number of individuals, so boards processed in tiles can be added up
+    race = population[..., None, :, :].astype(np.intp)
+    number_same = np.take_along_axis(counts, race, axis=-3)[..., 0, :, :] - 1
+
+    occupied = population != 0
+    ratios = np.where(occupied, number_same / neighbourhood_size, 0)
+    return ratios.sum(axis=(-2, -1)), occupied.sum(axis=(-2, -1))
+
+
+def mean_same_race_ratio(population, counts, neighbourhood):
+    # Average of the same race ratio over the individuals, every leading axis of population (replicates) gets its own value
+    neighbourhood_size = as_neighbourhood(neighbourhood).sizes(population.shape[-2:]) - 1
+    neigh_sum, number_of_ind = same_race_ratio_sums(population, counts, neighbourhood_size)
+    return np.where(number_of_ind > 0, neigh_sum / np.maximum(number_of_ind, 1), 1.0)
+
+
+def race_numbers(population):
+    # Number of empty cells followed by the number of individuals of each race
+    return np.bincount(population.reshape(-1), minlength=6)
+
+
+def race_adjacency(population, counts):
+    # adjacency[r - 1, s - 1] is the number of race s neighbours summed over every individual of race r,
+    # an individual doesn't count itself
+    cells = population.reshape(-1)
+    adjacency = np.empty((6, 6), dtype=np.int64)
+    for other in range(6):
+        adjacency[:, other] = np.bincount(cells, weights=counts[other].reshape(-1), minlength=6)
+    adjacency = adjacency[1:, 1:]
+    adjacency -= np.diag(race_numbers(population)[1:])
+    return adjacency
+
+
+def races_dict(adjacency):
+    # Nested dict keyed by race number strings, the form displayed by the GUI
+    return {str(race + 1): {str(other + 1): int(adjacency[race, other]) for other in range(5)} for race in range(5)}
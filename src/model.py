@@ -0,0 +1,707 @@
+import heapq
+import numpy as np
+
+from neighbourhood import *
+from metrics import *
+from convergence import *
+from storage import *
+from domain import DomainDecomposition
+from kernels import *
+
+
+# Bumped by every change that alters the boards or the records a seed gives, results cached by an older version are
+# not reused
+MODEL_VERSION = 2
+
+COLOURS = ['white', 'gold', 'limegreen', 'purple', 'red', 'royalblue']
+
+# Cell edges are only drawn on boards up to this many cells per side
+PLOT_EDGES_SIDE = 50
+
+# Minimum number of uniform draws requested from the generator at once
+DRAW_BATCH = 256
+
+# Number of cells drawn at once when generating a board
+POPULATION_CHUNK = 1 << 20
+
+# Default number of cells of a stripe of the tiled engine
+TILE_CELLS = 1 << 22
+
+# Rounds of rejection sampling before giving up on finding more empty cells
+SAMPLING_ATTEMPTS = 8
+
+# Share of the cells unhappy at the start of a round above which the incremental engine runs a reference round, which
+# reads every agent once instead of re-reading the neighbours of every move
+INCREMENTAL_SHARE = 0.04
+
+
+def seed_sequence(seed=None):
+    # Accepts None, an integer, a SeedSequence or a Generator, child streams are then obtained with spawn()
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(int(seed.integers(2 ** 63)))
+    return np.random.SeedSequence(seed)
+
+
+def random_population(rng, width, height, empty_ratio, races_ratios=None, out=None):
+    if races_ratios:
+        ratios = races_ratios.copy()
+        ratios.insert(0, empty_ratio)
+    else:
+        ratios = [
+            empty_ratio,
+            (1 - empty_ratio) / 5,
+            (1 - empty_ratio) / 5,
+            (1 - empty_ratio) / 5,
+            (1 - empty_ratio) / 5,
+            (1 - empty_ratio) / 5
+        ]
+
+    # Actual size of population
+    population_size = int(width) * int(height)
+    # Generate starting placement, in chunks so no temporary array is as large as the board in 64-bit integers
+    if out is None:
+        out = np.empty((int(height), int(width)), dtype=POPULATION_DTYPE)
+    population = out.reshape(-1)
+    values = np.arange(6, dtype=POPULATION_DTYPE)
+    for start in range(0, population_size, POPULATION_CHUNK):
+        stop = min(start + POPULATION_CHUNK, population_size)
+        population[start:stop] = rng.choice(values, size=stop - start, p=ratios)
+
+    return out
+
+
+def index_dtype(size):
+    return np.int32 if size < 2 ** 31 else np.int64
+
+
+def pack_population(population):
+    # Three bit planes packed 8 cells per byte, 3 bits per cell instead of 8
+    cells = population.reshape(-1)
+    return np.concatenate([np.packbits((cells >> bit) & 1) for bit in range(3)])
+
+
+def unpack_population(packed, height, width):
+    size = int(height) * int(width)
+    planes = np.split(packed, 3)
+    population = np.zeros(size, dtype=POPULATION_DTYPE)
+    for bit, plane in enumerate(planes):
+        population |= np.unpackbits(plane, count=size) << bit
+    return population.reshape(int(height), int(width))
+
+
+class Schelling:
+
+    def __init__(self, width, height, empty_ratio, similarity_threshold, neighbour_depth, races_ratios=None, engine='reference', seed=None, storage=None, tile_rows=None, workers=None, profiler=None, neighbourhood_shape='moore', boundary='open', population=None, recorder=None):
+        self.kernel = get_kernel(engine)
+        if storage is not None and (self.kernel.free_cells or self.kernel.counts):
+            raise ValueError("A board stored in a file needs an engine that keeps no whole-board structure, such as 'tiled'")
+        self.engine = engine
+        self.rng = np.random.default_rng(seed)
+        # Path of the memory-mapped board file, None keeps the board in memory
+        self.storage = storage
+        self.tile_rows = tile_rows
+        # Worker processes of the 'domain' engine, None uses every core
+        self.workers = workers
+        self.domain = None
+        # Shape and border of the neighbourhood built from neighbour_depth, see neighbourhood.py
+        self.neighbourhood_shape = neighbourhood_shape
+        self.boundary = boundary
+        # Profiler timing the phases of the rounds, see profiler.py
+        self.profiler = None
+        if profiler is not None:
+            profiler.attach(self)
+
+        self.model_configure(width, height, empty_ratio, similarity_threshold, neighbour_depth, races_ratios, population)
+        # Recorder logging the moves of every round from the board just made, see trajectory.py
+        if recorder is not None:
+            recorder.attach(self)
+
+    
+    def model_configure(self, width, height, empty_ratio, similarity_threshold, neighbour_depth, races_ratios=None, population=None):
+        # neighbour_depth is an int, or a Neighbourhood for shapes such as a circle of a non-integer radius
+        if isinstance(neighbour_depth, Neighbourhood):
+            self.neighbourhood = neighbour_depth
+        else:
+            self.neighbourhood = Neighbourhood(neighbour_depth, self.neighbourhood_shape, self.boundary)
+        self.width = width
+        self.height = height
+        self.empty_ratio = empty_ratio
+        self.similarity_threshold = similarity_threshold
+        self.neighbour_depth = self.neighbourhood.depth
+
+        # A given starting board is copied and its size is used, so one board can start many runs
+        if population is not None:
+            height, width = population.shape
+        out = None
+        if self.storage is not None:
+            out = create_grid(self.storage, height, width)
+        if population is None:
+            population = random_population(self.rng, width, height, empty_ratio, races_ratios, out)
+        elif out is not None:
+            out[...] = population
+            population = out
+        else:
+            population = np.array(population, dtype=POPULATION_DTYPE)
+        self.set_population(population)
+
+
+    def set_population(self, population):
+        # Installs a board and rebuilds everything derived from it
+        if not isinstance(population, np.memmap):
+            population = np.ascontiguousarray(population, dtype=POPULATION_DTYPE)
+        if self.kernel.prepare is not None:
+            population = self.kernel.prepare(self, population)
+        self.population = population
+        self.height, self.width = self.population.shape
+        self.neighbourhood.check_board(self.height, self.width)
+        if self.tile_rows is None:
+            self.tile_rows = max(1, TILE_CELLS // self.width)
+
+        self.draws = np.empty(0)
+        self.draw_position = 0
+        self.number_unhappy = None
+        self.number_moves = 0
+        # Individuals looked at in the last round, None when every individual was
+        self.number_evaluated = None
+        self.unhappy_history = []
+        self.stop_reason = None
+        self.round_number = 0
+
+        if self.kernel.free_cells:
+            self.build_empty_index()
+
+        # Neighbour counts per race, patched locally on every move, and the neighbourhood lookup table used to patch
+        # them, None when the kernel doesn't keep them
+        self.counts = None
+        self.neighbour_index = None
+        if self.kernel.counts:
+            self.counts = self.neighbour_counts()
+            self.neighbour_index = NeighbourIndex(self.neighbourhood, self.height, self.width)
+            # Change of the (empty, race) counts of a window an individual leaves, -1 wraps around the unsigned dtype
+            self.leave_step = np.array([1, -1]).astype(self.counts.dtype).reshape(2, 1, 1)
+
+        if self.kernel.setup is not None:
+            self.kernel.setup(self)
+
+
+    def packed_population(self):
+        return pack_population(self.population)
+
+
+    def build_empty_index(self):
+        # Free cells are kept in a swap-remove array, empty_slot maps each cell to its slot (-1 when occupied)
+        cells = self.population.reshape(-1)
+        dtype = index_dtype(cells.size)
+        self.empty_cells = np.flatnonzero(cells == 0).astype(dtype)
+        self.empty_slot = np.full(cells.size, -1, dtype=dtype)
+        self.empty_slot[self.empty_cells] = np.arange(self.empty_cells.size, dtype=dtype)
+
+
+    def reserve_draws(self, number):
+        # Makes sure at least number uniform draws are buffered, they are taken from the generator in one batch
+        remaining = self.draws[self.draw_position:]
+        if remaining.size < number:
+            self.draws = np.concatenate((remaining, self.rng.random(max(number - remaining.size, DRAW_BATCH))))
+            self.draw_position = 0
+
+
+    def random_empty_cell(self):
+        if self.draw_position == self.draws.size:
+            self.reserve_draws(DRAW_BATCH)
+        draw = self.draws[self.draw_position]
+        self.draw_position += 1
+        number_empty = self.empty_cells.size
+        return self.empty_cells[min(int(draw * number_empty), number_empty - 1)]
+
+
+    def move(self, source, destination):
+        # source is an occupied cell and destination an empty one, both as flat indices
+        cells = self.population.reshape(-1)
+        race = cells[source]
+        cells[destination] = race
+        cells[source] = 0
+
+        slot = self.empty_slot[destination]
+        self.empty_cells[slot] = source
+        self.empty_slot[source] = slot
+        self.empty_slot[destination] = -1
+
+        if self.neighbourhood.box():
+            # The empty plane and the race plane are one strided slice, patched with a single (+1, -1) step per window
+            planes = slice(0, race + 1, race)
+            depth = self.neighbourhood.depth
+            row, col = divmod(int(source), self.width)
+            self.counts[planes, max(row - depth, 0):row + depth + 1, max(col - depth, 0):col + depth + 1] += self.leave_step
+            row, col = divmod(int(destination), self.width)
+            self.counts[planes, max(row - depth, 0):row + depth + 1, max(col - depth, 0):col + depth + 1] -= self.leave_step
+            return
+
+        # The neighbourhood cells of a board are distinct, so the fancy-indexed updates don't lose repeated indices
+        counts = self.counts.reshape(-1)
+        offset = int(race) * cells.size
+        window = self.neighbour_index.cells(source)
+        counts[window + offset] -= 1
+        counts[window] += 1
+        window = self.neighbour_index.cells(destination)
+        counts[window + offset] += 1
+        counts[window] -= 1
+
+
+    def print_to_console(self):
+        print('-' * (len(self.population) * 2 + 2))
+        for x in self.population:
+            row_str = "| "
+            for y in x:
+                if y == 1:
+                    row_str += "# "
+                elif y == 2:
+                    row_str += "O "
+                elif y == 3:
+                    row_str += "* "
+                elif y == 4:
+                    row_str += "+ "
+                elif y == 5:
+                    row_str += "X "
+                else:
+                    row_str += "  "
+            row_str = row_str[:-1] + "|" 
+            print(row_str)
+        print('-' * (len(self.population) * 2 + 2))
+
+
+    def run_round(self):
+        self.round_number += 1
+        return self.kernel.step(self)
+
+
+    def run(self, max_iterations, monitor=None, resume=False, on_round=None):
+        # Runs rounds until every individual is happy, the monitor detects a steady state or max_iterations is reached,
+        # returns the number of iterations and the reason of the stop. resume carries on a run restored with set_state,
+        # on_round(schelling, monitor) is called after every round that doesn't end the run
+        if not resume:
+            if monitor is not None:
+                monitor.reset()
+            self.unhappy_history = []
+        number_iterations = len(self.unhappy_history)
+        while True:
+            finished = self.run_round()
+            self.unhappy_history.append(int(self.number_unhappy))
+            if finished:
+                self.stop_reason = ALL_HAPPY
+                break
+            if monitor is not None:
+                self.stop_reason = monitor.update(self)
+                if self.stop_reason is not None:
+                    break
+            if number_iterations >= max_iterations:
+                self.stop_reason = MAX_ITERATIONS
+                break
+            number_iterations += 1
+            if on_round is not None:
+                on_round(self, monitor)
+        return number_iterations, self.stop_reason
+
+
+    def get_state(self):
+        # What a run needs besides its parameters to carry on exactly where it was, the unused buffered draws and the
+        # order of the free cell index included
+        state = {
+            'population': np.array(self.population),
+            'draws': self.draws[self.draw_position:].copy(),
+            'rng_state': self.rng.bit_generator.state,
+            'round_number': self.round_number,
+            'unhappy_history': list(self.unhappy_history)
+        }
+        if self.kernel.free_cells:
+            state['empty_cells'] = self.empty_cells.copy()
+        return state
+
+
+    def set_state(self, state):
+        self.set_population(state['population'])
+        self.draws = np.asarray(state['draws'], dtype=float)
+        self.draw_position = 0
+        if 'empty_cells' in state:
+            self.empty_cells = np.asarray(state['empty_cells'], dtype=self.empty_cells.dtype)
+            self.empty_slot[self.empty_cells] = np.arange(self.empty_cells.size, dtype=self.empty_slot.dtype)
+        self.rng.bit_generator.state = state['rng_state']
+        self.round_number = state['round_number']
+        self.unhappy_history = list(state['unhappy_history'])
+
+
+    def run_round_reference(self):
+        # Happiness comes from the maintained counts, an O(1) lookup per agent, move() patches them as agents move
+        self.reserve_draws(np.count_nonzero(self.unhappy_mask()))
+        number_unhappy = 0
+        number_moves = 0
+        number_evaluated = 0
+        cells = self.population.reshape(-1)
+        counts = self.counts.reshape(6, -1)
+        for index in range(cells.size):
+            race = cells[index]
+            if race != 0: # not empty
+                number_evaluated = number_evaluated + 1
+                neighbourhood = counts[:, index].tolist()
+
+                number_occupied = sum(neighbourhood[1:]) - 1 # other individuals in the neighbourhood
+                
+                if number_occupied > 0:
+                    number_similar = neighbourhood[race] - 1
+                    similarity_ratio = number_similar / number_occupied
+                    
+                    if similarity_ratio < self.similarity_threshold: # unhappy
+                        number_unhappy = number_unhappy + 1
+                        if self.empty_cells.size > 0:
+                            self.move(index, self.random_empty_cell())
+                            number_moves = number_moves + 1
+        self.number_unhappy = number_unhappy
+        self.number_moves = number_moves
+        self.number_evaluated = number_evaluated
+        if number_unhappy == 0:
+            return True
+        return False
+
+
+    def run_round_synchronous(self):
+        unhappy = np.flatnonzero(self.unhappy_mask())
+        self.number_unhappy = unhappy.size
+        self.number_moves = 0
+        if unhappy.size == 0:
+            return True
+
+        self.synchronous_moves(unhappy)
+        self.counts = self.neighbour_counts()
+        return False
+
+
+    def run_round_domain(self):
+        unhappy = self.domain.unhappy(self.neighbourhood, self.similarity_threshold)
+        self.number_unhappy = unhappy.size
+        self.number_moves = 0
+        if unhappy.size == 0:
+            return True
+
+        self.synchronous_moves(unhappy)
+        return False
+
+
+    def synchronous_moves(self, unhappy):
+        # Moves a random subset of the unhappy cells (flat indices in row-major order) to random empty cells
+        number_moves = min(unhappy.size, self.empty_cells.size)
+        self.number_moves = number_moves
+        movers = self.rng.permutation(unhappy)[:number_moves]
+        slots = self.rng.permutation(self.empty_cells.size)[:number_moves]
+        destinations = self.empty_cells[slots]
+
+        cells = self.population.reshape(-1)
+        cells[destinations] = cells[movers]
+        cells[movers] = 0
+
+        self.empty_cells[slots] = movers
+        self.empty_slot[movers] = slots
+        self.empty_slot[destinations] = -1
+
+
+    def run_round_incremental(self):
+        # Same visiting order as the reference engine, but only over the agents unhappy when the round starts, found
+        # in one pass over the counts, and the agents after the current position whose neighbourhood a move changed.
+        # Happiness is read from the maintained counts when an agent is reached. Both give the same moves
+        pending = np.flatnonzero(self.unhappy_mask()).tolist()
+        if len(pending) > INCREMENTAL_SHARE * self.population.size:
+            return self.run_round_reference()
+        self.reserve_draws(len(pending))
+        number_unhappy = 0
+        number_moves = 0
+        number_evaluated = 0
+        cells = self.population.reshape(-1)
+        counts = self.counts.reshape(6, -1)
+        queued = set(pending)
+        while pending:
+            index = heapq.heappop(pending)
+            queued.discard(index)
+            race = cells[index]
+            if race == 0:
+                continue
+            number_evaluated = number_evaluated + 1
+            neighbourhood = counts[:, index].tolist()
+            number_occupied = sum(neighbourhood[1:]) - 1 # other individuals in the neighbourhood
+            if number_occupied <= 0 or (neighbourhood[race] - 1) / number_occupied >= self.similarity_threshold:
+                continue
+
+            number_unhappy = number_unhappy + 1
+            if self.empty_cells.size > 0:
+                destination = int(self.random_empty_cell())
+                self.move(index, destination)
+                number_moves = number_moves + 1
+                # An agent can only become unhappy by losing a neighbour of its race or gaining one of another race:
+                # the agents of the mover's race around the source, the others around the destination and the mover
+                # itself. Those after the current position are queued, the others wait for the next round
+                window = self.neighbour_index.cells(index)
+                agents = window[(window > index) & (cells[window] == race)].tolist()
+                window = self.neighbour_index.cells(destination)
+                races = cells[window]
+                agents += window[(window > index) & (races != race) & (races != 0)].tolist()
+                if destination > index:
+                    agents.append(destination)
+                for agent in agents:
+                    if agent not in queued:
+                        heapq.heappush(pending, agent)
+                        queued.add(agent)
+        self.number_unhappy = number_unhappy
+        self.number_moves = number_moves
+        self.number_evaluated = number_evaluated
+        if number_unhappy == 0:
+            return True
+        return False
+
+
+    def run_round_tiled(self):
+        # Stripe after stripe, the unhappy individuals of a stripe are decided from the stripe and its halo rows,
+        # then moved to empty cells found anywhere on the board, the next stripes see those moves
+        number_unhappy = 0
+        number_moves = 0
+        cells = self.population.reshape(-1)
+        for top, block, counts, rows in self.tiles():
+            unhappy = np.flatnonzero(unhappy_mask(block, counts, self.similarity_threshold)[rows]) + top * self.width
+            number_unhappy += unhappy.size
+
+            destinations = self.sample_empty_cells(unhappy.size)
+            movers = self.rng.permutation(unhappy)[:destinations.size]
+            cells[destinations] = cells[movers]
+            cells[movers] = 0
+            number_moves += movers.size
+
+        if isinstance(self.population, np.memmap):
+            self.population.flush()
+        self.number_unhappy = number_unhappy
+        self.number_moves = number_moves
+        if number_unhappy == 0:
+            return True
+        return False
+
+
+    def tiles(self):
+        # Yields every stripe of tile_rows rows as (first row, stripe with its halo, counts of the stripe with its halo,
+        # rows of the stripe inside the halo block), only one stripe is in memory at a time
+        for top in range(0, self.height, self.tile_rows):
+            bottom = min(top + self.tile_rows, self.height)
+            block, rows = halo_block(self.population, top, bottom, self.neighbourhood)
+            yield top, block, neighbour_counts(block, self.neighbourhood, halo=True), rows
+
+
+    def sample_empty_cells(self, number):
+        # Rejection sampling of distinct empty cells, needs no index of the empty cells and costs about
+        # number / empty_ratio reads, returns fewer cells when the board has too few empty ones
+        cells = self.population.reshape(-1)
+        found = np.empty(0, dtype=np.int64)
+        for _ in range(SAMPLING_ATTEMPTS):
+            missing = number - found.size
+            if missing <= 0:
+                break
+            candidates = self.rng.integers(0, cells.size, size=int(missing / max(self.empty_ratio, 0.01) * 1.25) + 16)
+            candidates = np.concatenate((found, candidates[cells[candidates] == 0]))
+            _, first = np.unique(candidates, return_index=True)
+            found = candidates[np.sort(first)]
+        return found[:number]
+
+
+    def checkpoint(self):
+        # The board file already holds the board, only the parameters and the generator state are written
+        self.population.flush()
+        write_metadata(self.storage, {
+            'width': self.width,
+            'height': self.height,
+            'empty_ratio': self.empty_ratio,
+            'similarity_threshold': self.similarity_threshold,
+            'neighbourhood': self.neighbourhood.describe(),
+            'tile_rows': self.tile_rows,
+            'round_number': self.round_number,
+            'rng_state': self.rng.bit_generator.state
+        })
+
+
+    @classmethod
+    def restore(cls, storage):
+        metadata = read_metadata(storage)
+        schelling = cls.__new__(cls)
+        schelling.engine = 'tiled'
+        schelling.kernel = get_kernel('tiled')
+        schelling.rng = np.random.default_rng()
+        schelling.rng.bit_generator.state = metadata['rng_state']
+        schelling.storage = storage
+        schelling.tile_rows = metadata['tile_rows']
+        schelling.workers = None
+        schelling.domain = None
+        schelling.profiler = None
+        schelling.empty_ratio = metadata['empty_ratio']
+        schelling.similarity_threshold = metadata['similarity_threshold']
+        # Boards checkpointed before the neighbourhood shapes only have a depth
+        schelling.neighbourhood = Neighbourhood(**metadata.get('neighbourhood', {'depth': metadata.get('neighbour_depth', 1)}))
+        schelling.neighbour_depth = schelling.neighbourhood.depth
+        schelling.neighbourhood_shape = schelling.neighbourhood.shape
+        schelling.boundary = schelling.neighbourhood.boundary
+        schelling.set_population(open_grid(storage, metadata['height'], metadata['width']))
+        schelling.round_number = metadata['round_number']
+        return schelling
+
+
+    def prepare_domain(self, population):
+        self.close()
+        self.domain = DomainDecomposition(population, self.workers)
+        return self.domain.population
+
+
+    def close(self):
+        # Stops the worker processes and frees the shared board of the 'domain' engine
+        if self.domain is not None:
+            self.population = np.array(self.population)
+            self.domain.close()
+            self.domain = None
+
+
+    def neighbour_counts(self):
+        return neighbour_counts(self.population, self.neighbourhood)
+
+
+    def unhappy_mask(self):
+        if self.counts is None:
+            return np.concatenate([unhappy_mask(block, counts, self.similarity_threshold)[rows] for _, block, counts, rows in self.tiles()])
+        return unhappy_mask(self.population, self.counts, self.similarity_threshold)
+
+
+    def create_plot(self):
+        # matplotlib is only loaded when a plot is requested, so the model stays importable without a display
+        import matplotlib.pyplot as plt
+        from matplotlib.colors import ListedColormap
+
+        self.cmap = ListedColormap(COLOURS)
+
+        plt.style.use("ggplot")
+
+        self.fig, self.ax = plt.subplots()
+        self.image = None
+        
+        self.update_plot()
+
+
+    def update_plot(self, population=None):
+        # The board is one image created once, later rounds replace its data and blit the axes only. population is a
+        # copy of the board to draw instead of the live one, as made by a thread stepping the model
+        if population is None:
+            population = self.population
+        frame, step = self.plot_frame(population)
+        if self.image is None or self.image.get_array().shape != frame.shape:
+            self.build_plot(frame, step, population.shape)
+        else:
+            self.image.set_data(frame)
+            if self.fig.canvas.supports_blit:
+                # The image covers the whole axes, it is drawn over the previous frame
+                self.ax.draw_artist(self.image)
+                if self.plot_edges is not None:
+                    self.ax.draw_artist(self.plot_edges)
+                self.fig.canvas.blit(self.ax.bbox)
+            else:
+                self.fig.canvas.draw()
+
+
+    def plot_frame(self, population):
+        # Every step-th cell of every step-th row, so the frame has no more cells than the axes have pixels
+        height, width = population.shape
+        step = max(1, int(np.ceil(max(height / self.ax.bbox.height, width / self.ax.bbox.width))))
+        return np.asarray(population[::step, ::step]), step
+
+
+    def build_plot(self, frame, step, shape):
+        from matplotlib.collections import LineCollection
+        height, width = shape
+
+        self.ax.clear()
+        self.ax.axis('off')
+        self.image = self.ax.imshow(frame, cmap=self.cmap, vmin=0, vmax=5, interpolation='nearest', origin='lower', aspect='auto')
+
+        self.plot_edges = None
+        if step == 1 and max(height, width) <= PLOT_EDGES_SIDE:
+            rows = np.arange(height + 1) - 0.5
+            cols = np.arange(width + 1) - 0.5
+            segments = [((cols[0], row), (cols[-1], row)) for row in rows] + [((col, rows[0]), (col, rows[-1])) for col in cols]
+            self.plot_edges = self.ax.add_collection(LineCollection(segments, colors='w', linewidths=1))
+        self.fig.canvas.draw()
+
+
+    def get_neighbourhood(self, row, col):
+        # Values of the cells of the neighbourhood of (row, col), itself included, as a flat array. An open Moore window
+        # is a clipped slice of the board, the other shapes and the torus go through the neighbourhood lookup table
+        if self.neighbourhood.box():
+            depth = self.neighbourhood.depth
+            return self.population[max(row - depth, 0):row + depth + 1, max(col - depth, 0):col + depth + 1].reshape(-1)
+        index = row * self.width + col
+        if self.neighbour_index is None:
+            return self.population.reshape(-1)[self.neighbourhood.cells(index, self.height, self.width)]
+        return self.population.reshape(-1)[self.neighbour_index.cells(index)]
+
+
+    def get_ratio_of_individuals_same_race_in_neighbourhood(self, row, col):
+        race = self.population[row, col]
+        neighbourhood = self.get_neighbourhood(row, col)
+        size = np.size(neighbourhood) - 1
+        number = len(np.where(neighbourhood == race)[0]) - 1
+        ratio = number / size
+        return ratio
+
+    def get_race(self, row, col):
+        return self.population[row, col]
+
+    def race_adjacency(self):
+        if self.counts is None:
+            return sum(race_adjacency(block[rows], counts[:, rows]) for _, block, counts, rows in self.tiles())
+        return race_adjacency(self.population, self.counts)
+
+
+    def neighbourhood_numbers(self):
+        if self.counts is None:
+            neigh_sum = 0
+            number_of_ind = 0
+            for _, block, counts, rows in self.tiles():
+                neighbourhood_size = self.neighbourhood.sizes(block.shape)[rows] - 1
+                tile_sum, tile_number = same_race_ratio_sums(block[rows], counts[:, rows], neighbourhood_size)
+                neigh_sum += tile_sum
+                number_of_ind += tile_number
+            if number_of_ind == 0:
+                return 1.0
+            return float(neigh_sum / number_of_ind)
+        return float(mean_same_race_ratio(self.population, self.counts, self.neighbourhood))
+
+
+    def race_numbers(self):
+        if self.counts is None:
+            return sum(race_numbers(block[rows]) for _, block, counts, rows in self.tiles())
+        return race_numbers(self.population)
+
+
+    def statistics(self):
+        numbers = self.race_numbers()
+
+        info_dict = {}
+        info_dict['Number_of_Empty'] = int(numbers[0])
+        info_dict['Number_of_RaceA'] = int(numbers[1])
+        info_dict['Number_of_RaceB'] = int(numbers[2])
+        info_dict['Number_of_RaceC'] = int(numbers[3])
+        info_dict['Number_of_RaceD'] = int(numbers[4])
+        info_dict['Number_of_RaceE'] = int(numbers[5])
+
+        info_dict['races_dict'] = races_dict(self.race_adjacency())
+
+        return info_dict
+
+
+# 'reference' moves agents one at a time in row-major order, 'synchronous' decides every move from one snapshot
+# and 'incremental' follows the reference order but only visits the agents that are currently unhappy,
+# 'tiled' decides the moves stripe by stripe and keeps no whole-board structure, for boards stored on disk,
+# 'domain' gives the same moves as 'synchronous' with the unhappy cells found by worker processes over shared memory
+register_kernel('reference', 'sequential')(Schelling.run_round_reference)
+register_kernel('synchronous', 'synchronous')(Schelling.run_round_synchronous)
+register_kernel('incremental', 'sequential')(Schelling.run_round_incremental)
+register_kernel('tiled', 'tiled', free_cells=False, counts=False)(Schelling.run_round_tiled)
+register_kernel('domain', 'synchronous', counts=False, prepare=Schelling.prepare_domain)(Schelling.run_round_domain)
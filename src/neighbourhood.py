@@ -0,0 +1,235 @@
+import numpy as np
+
+
+# The board holds one of six values per cell (0 is empty, 1 to 5 are the races), one byte each
+POPULATION_DTYPE = np.uint8
+
+
+# Shapes of neighbourhood: every cell within depth rows and columns, within depth steps, or within a euclidean radius
+SHAPES = ('moore', 'von_neumann', 'circle')
+
+# Cells past an open border are missing from the neighbourhood, a torus wraps them around to the other side
+BOUNDARIES = ('open', 'torus')
+
+
+class Neighbourhood:
+
+    # The cells around a cell that make its neighbourhood, itself included, as (row, column) offsets. Every shape is
+    # symmetric and has one run of columns per row offset, so a whole-board sum is a row window sum per distinct run
+    # added over the row offsets. radius is only used by 'circle' and defaults to depth
+    def __init__(self, depth=1, shape='moore', boundary='open', radius=None):
+        if shape not in SHAPES:
+            raise ValueError("Unknown neighbourhood shape '" + str(shape) + "', expected one of " + ", ".join(SHAPES))
+        if boundary not in BOUNDARIES:
+            raise ValueError("Unknown boundary '" + str(boundary) + "', expected one of " + ", ".join(BOUNDARIES))
+        if shape == 'circle':
+            radius = depth if radius is None else radius
+            depth = int(np.floor(radius))
+        self.depth = int(depth)
+        self.shape = shape
+        self.boundary = boundary
+        self.radius = radius
+
+        # half_widths[depth + dr] is the number of columns on each side of the centre at row offset dr
+        row_offsets = np.arange(-self.depth, self.depth + 1)
+        if shape == 'moore':
+            self.half_widths = np.full(row_offsets.size, self.depth)
+        elif shape == 'von_neumann':
+            self.half_widths = self.depth - np.abs(row_offsets)
+        else:
+            self.half_widths = np.floor(np.sqrt(radius ** 2 - row_offsets ** 2) + 1e-9).astype(int)
+        self.offsets = np.array([(row, col) for row, half_width in zip(row_offsets, self.half_widths) for col in range(-half_width, half_width + 1)], dtype=np.intp)
+        self.size = len(self.offsets)
+
+
+    def __eq__(self, other):
+        return isinstance(other, Neighbourhood) and self.describe() == other.describe()
+
+
+    def __repr__(self):
+        return 'Neighbourhood(' + ', '.join(key + '=' + repr(value) for key, value in self.describe().items()) + ')'
+
+
+    def describe(self):
+        # Plain dict that rebuilds it with Neighbourhood(**description), for metadata files
+        return {'depth': self.depth, 'shape': self.shape, 'boundary': self.boundary, 'radius': self.radius}
+
+
+    def box(self):
+        # Open Moore windows have a faster clipped path than the padded one
+        return self.shape == 'moore' and self.boundary == 'open'
+
+
+    def check_board(self, height, width):
+        # A torus narrower than the window would count some cells twice
+        if self.boundary == 'torus' and (height <= 2 * self.depth or width <= 2 * self.depth):
+            raise ValueError("A torus of " + str(height) + "x" + str(width) + " cells is too small for a neighbourhood of depth " + str(self.depth))
+
+
+    def pad(self, planes, wrap_rows=True):
+        # Planes with depth extra cells on every side: zeros past an open border, the other side of the board on a torus
+        pad_width = [(0, 0)] * (planes.ndim - 2) + [(self.depth, self.depth)] * 2
+        if self.boundary == 'open':
+            return np.pad(planes, pad_width)
+        padded = np.pad(planes, pad_width, mode='wrap')
+        if not wrap_rows:
+            padded[..., :self.depth, :] = 0
+            padded[..., padded.shape[-2] - self.depth:, :] = 0
+        return padded
+
+
+    def window_sums(self, planes, dtype=None, halo=False):
+        # Sum of every neighbourhood over the last two axes of planes. halo tells the rows are a stripe that already
+        # holds depth rows of halo on each side, so a torus wraps its columns only
+        if self.box():
+            return box_sums(planes, self.depth, dtype)
+        height, width = planes.shape[-2:]
+        depth = self.depth
+        accumulator = np.int32 if self.size * max(height, width) < 2 ** 31 else np.int64
+
+        padded = self.pad(planes, not halo)
+        table = np.zeros(padded.shape[:-1] + (padded.shape[-1] + 1,), dtype=accumulator)
+        np.cumsum(padded, axis=-1, dtype=accumulator, out=table[..., 1:])
+        cols = np.arange(width) + depth
+        row_sums = {half_width: table[..., cols + half_width + 1] - table[..., cols - half_width] for half_width in set(self.half_widths.tolist())}
+
+        sums = np.zeros(planes.shape, dtype=accumulator)
+        for row, half_width in enumerate(self.half_widths.tolist()):
+            sums += row_sums[half_width][..., row:row + height, :]
+        if dtype is None:
+            return sums
+        return sums.astype(dtype)
+
+
+    def sizes(self, shape):
+        # Number of cells of the neighbourhood of every cell of a board, smaller along open borders
+        if self.boundary == 'torus':
+            return np.full(shape, self.size)
+        return self.window_sums(np.ones(shape, dtype=np.uint8))
+
+
+    def cells(self, index, height, width):
+        # Flat indices of the neighbourhood of the cell at flat index, which are also the cells whose neighbourhood
+        # holds it since every shape is symmetric
+        row, col = divmod(int(index), width)
+        rows = self.offsets[:, 0] + row
+        cols = self.offsets[:, 1] + col
+        if self.boundary == 'torus':
+            return (rows % height) * width + cols % width
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        return rows[inside] * width + cols[inside]
+
+
+class NeighbourIndex:
+
+    # Lookup tables of the neighbourhoods of one board. A cell at least depth cells away from every border has its
+    # neighbourhood at fixed flat offsets from it. The others read a grid of the flat index of every cell padded with
+    # depth cells on each side, -1 past an open border and the wrapped cell on a torus, sliced around the cell and
+    # masked by the shape unless it is a full square
+    def __init__(self, neighbourhood, height, width):
+        self.depth = neighbourhood.depth
+        self.height = height
+        self.width = width
+        self.span = 2 * self.depth + 1
+        self.open = neighbourhood.boundary == 'open'
+        dtype = np.int32 if height * width < 2 ** 31 else np.int64
+        self.offsets = (neighbourhood.offsets[:, 0] * width + neighbourhood.offsets[:, 1]).astype(dtype)
+
+        flat = np.arange(height * width, dtype=dtype).reshape(height, width)
+        if self.open:
+            self.grid = np.pad(flat, self.depth, constant_values=-1)
+        else:
+            self.grid = np.pad(flat, self.depth, mode='wrap')
+
+        self.stencil = None
+        if neighbourhood.size < self.span ** 2:
+            self.stencil = np.zeros((self.span, self.span), dtype=bool)
+            self.stencil[neighbourhood.offsets[:, 0] + self.depth, neighbourhood.offsets[:, 1] + self.depth] = True
+
+
+    def cells(self, index):
+        # Same cells, in the same order, as Neighbourhood.cells
+        index = int(index)
+        row, col = divmod(index, self.width)
+        if self.depth <= row < self.height - self.depth and self.depth <= col < self.width - self.depth:
+            return self.offsets + index
+
+        window = self.grid[row:row + self.span, col:col + self.span]
+        cells = window.reshape(-1) if self.stencil is None else window[self.stencil]
+        if self.open:
+            return cells[cells >= 0]
+        return cells
+
+
+def as_neighbourhood(neighbourhood):
+    # An int is the depth of a Moore neighbourhood with open borders
+    if isinstance(neighbourhood, Neighbourhood):
+        return neighbourhood
+    return Neighbourhood(neighbourhood)
+
+
+def count_dtype(neighbourhood):
+    # Smallest unsigned type able to hold the number of cells of a neighbourhood
+    return np.min_scalar_type(as_neighbourhood(neighbourhood).size)
+
+
+def box_sums(planes, depth, dtype=None):
+    # Sum of every (2 * depth + 1)^2 window, clipped at the borders, through cumulative sums along each axis
+    height, width = planes.shape[-2:]
+    accumulator = np.int32 if (2 * depth + 1) * max(height, width) < 2 ** 31 else np.int64
+
+    cols = np.arange(width)
+    left = np.clip(cols - depth, 0, width)
+    right = np.clip(cols + depth + 1, 0, width)
+    table = np.zeros(planes.shape[:-2] + (height, width + 1), dtype=accumulator)
+    np.cumsum(planes, axis=-1, dtype=accumulator, out=table[..., 1:])
+    row_sums = table[..., right] - table[..., left]
+
+    rows = np.arange(height)
+    top = np.clip(rows - depth, 0, height)
+    bottom = np.clip(rows + depth + 1, 0, height)
+    table = np.zeros(planes.shape[:-2] + (height + 1, width), dtype=accumulator)
+    np.cumsum(row_sums, axis=-2, out=table[..., 1:, :])
+    sums = table[..., bottom, :] - table[..., top, :]
+
+    if dtype is None:
+        return sums
+    return sums.astype(dtype)
+
+
+def window_sums(planes, neighbourhood, dtype=None, halo=False):
+    return as_neighbourhood(neighbourhood).window_sums(planes, dtype, halo)
+
+
+def neighbour_counts(population, neighbourhood, halo=False):
+    # counts[..., k, row, col] is the number of cells of value k in the neighbourhood of (row, col), itself included,
+    # computed one value at a time to bound the temporary memory
+    neighbourhood = as_neighbourhood(neighbourhood)
+    counts = np.empty(population.shape[:-2] + (6,) + population.shape[-2:], dtype=count_dtype(neighbourhood))
+    for value in range(6):
+        counts[..., value, :, :] = neighbourhood.window_sums(population == value, halo=halo)
+    return counts
+
+
+def halo_block(population, top, bottom, neighbourhood):
+    # Copy of the rows top to bottom with depth rows of halo on each side, cut at an open border and wrapped around
+    # a torus, and the slice of the rows top to bottom inside it
+    depth = neighbourhood.depth
+    if neighbourhood.boundary == 'torus':
+        rows = np.arange(top - depth, bottom + depth) % population.shape[0]
+        return np.array(population[rows]), slice(depth, depth + bottom - top)
+    low = max(top - depth, 0)
+    high = min(bottom + depth, population.shape[0])
+    return np.array(population[low:high]), slice(top - low, bottom - low)
+
+
+def unhappy_mask(population, counts, similarity_threshold):
+    signed = np.promote_types(counts.dtype, np.int16)
+    race = population[..., None, :, :].astype(np.intp)
+    number_similar = np.take_along_axis(counts, race, axis=-3)[..., 0, :, :].astype(signed) - 1
+    number_occupied = counts[..., 1:, :, :].sum(axis=-3, dtype=signed) - 1 # other individuals in the neighbourhood
+
+    similarity_ratio = np.ones(number_similar.shape)
+    np.divide(number_similar, number_occupied, out=similarity_ratio, where=number_occupied > 0)
+
+    return (population != 0) & (number_occupied > 0) & (similarity_ratio < similarity_threshold)
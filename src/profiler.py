@@ -0,0 +1,169 @@
+import collections
+import contextlib
+import threading
+import time
+
+
+# Schelling methods timed by a profiler and the phase their time goes to
+PHASES = {
+    'unhappy_mask': 'neighbourhood',
+    'neighbour_counts': 'neighbourhood',
+    'get_neighbourhood': 'neighbourhood',
+    'random_empty_cell': 'empty cell search',
+    'sample_empty_cells': 'empty cell search',
+    'move': 'relocation',
+    'synchronous_moves': 'relocation',
+    'neighbourhood_numbers': 'metrics',
+    'race_adjacency': 'metrics',
+    'statistics': 'metrics',
+    'create_plot': 'plotting',
+    'update_plot': 'plotting'
+}
+
+# Counters updated after every round
+COUNTERS = ['rounds', 'agents evaluated', 'unhappy agents', 'moves', 'failed moves']
+
+# Time spent in a round outside of the timed methods (the loop of the kernel itself)
+OTHER = 'other'
+
+
+class Profiler:
+
+    # Wall time per phase and counts per round of a Schelling model. Attaching replaces the timed methods on the
+    # instance only, a model without a profiler runs the plain methods with no check at all. Time is exclusive: a
+    # timed method called from another one is counted in its own phase only. callback(profiler, round_record) is
+    # called after every round
+    def __init__(self, callback=None, window=20):
+        self.callback = callback
+        self.times = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.round_ends = collections.deque(maxlen=window)
+        # Stack of the phases entered and time of the last change, one per thread so the rounds can run in a worker
+        # thread while the plot is drawn in the GUI one
+        self.local = threading.local()
+        # Number of individuals of the board it was counted on, moves don't change it
+        self.individuals = None
+        self.board = None
+
+
+    def attach(self, schelling):
+        for method, phase in PHASES.items():
+            setattr(schelling, method, self.timed(getattr(schelling, method), phase))
+        schelling.run_round = self.timed_round(schelling, schelling.run_round)
+        schelling.profiler = self
+        return self
+
+
+    def detach(self, schelling):
+        for method in list(PHASES) + ['run_round']:
+            schelling.__dict__.pop(method, None)
+        schelling.profiler = None
+
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        local = self.local
+        if not hasattr(local, 'stack'):
+            local.stack = []
+        if local.stack:
+            self.times[local.stack[-1]] += now - local.mark
+        local.mark = now
+        local.stack.append(phase)
+        self.calls[phase] += 1
+
+
+    def leave(self):
+        now = time.perf_counter()
+        local = self.local
+        self.times[local.stack.pop()] += now - local.mark
+        local.mark = now
+
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        # For code outside the model, such as the canvas drawing of the GUI
+        self.enter(phase)
+        try:
+            yield
+        finally:
+            self.leave()
+
+
+    def timed(self, method, phase):
+        def timed_method(*args, **kwargs):
+            self.enter(phase)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.leave()
+        return timed_method
+
+
+    def timed_round(self, schelling, run_round):
+        def timed_run_round():
+            start = time.perf_counter()
+            self.enter(OTHER)
+            try:
+                finished = run_round()
+            finally:
+                self.leave()
+            self.end_round(schelling, time.perf_counter() - start)
+            return finished
+        return timed_run_round
+
+
+    def end_round(self, schelling, elapsed):
+        if schelling.number_evaluated is not None:
+            evaluated = schelling.number_evaluated
+        else:
+            if self.board is not schelling.population:
+                self.individuals = int(schelling.race_numbers()[1:].sum())
+                self.board = schelling.population
+            evaluated = self.individuals
+        record = {
+            'round': schelling.round_number,
+            'seconds': elapsed,
+            'agents evaluated': evaluated,
+            'unhappy agents': int(schelling.number_unhappy),
+            'moves': int(schelling.number_moves),
+            'failed moves': int(schelling.number_unhappy) - int(schelling.number_moves)
+        }
+        self.counts['rounds'] += 1
+        for counter in COUNTERS[1:]:
+            self.counts[counter] += record[counter]
+        self.round_ends.append(time.perf_counter())
+        if self.callback is not None:
+            self.callback(self, record)
+
+
+    def rounds_per_second(self):
+        # Rate over the last window rounds, measured between their ends so time spent between rounds counts too
+        if len(self.round_ends) < 2:
+            return 0.0
+        return (len(self.round_ends) - 1) / (self.round_ends[-1] - self.round_ends[0])
+
+
+    def report(self):
+        return {'times': dict(self.times), 'calls': dict(self.calls), 'counts': dict(self.counts)}
+
+
+    def merge(self, report):
+        # Adds a report of another profiler, such as one of a run in a worker process
+        for phase, seconds in report['times'].items():
+            self.times[phase] += seconds
+        for phase, calls in report['calls'].items():
+            self.calls[phase] += calls
+        for counter, number in report['counts'].items():
+            self.counts[counter] = self.counts.get(counter, 0) + number
+
+
+    def summary(self):
+        total = sum(self.times.values())
+        lines = []
+        for phase, seconds in sorted(self.times.items(), key=lambda item: -item[1]):
+            share = 100 * seconds / total if total > 0 else 0
+            lines.append(phase + ":\t" + str(round(seconds, 3)) + " s\t" + str(round(share, 1)) + " %\t" + str(self.calls[phase]) + " calls")
+        for counter in COUNTERS:
+            lines.append(counter + ":\t" + str(self.counts.get(counter, 0)))
+        return "\n".join(lines)
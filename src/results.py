@@ -0,0 +1,170 @@
+import json
+import os
+import numpy as np
+
+
+def seed_record(seed):
+    # A SeedSequence written as the two values that rebuild it: np.random.SeedSequence(entropy, spawn_key=spawn_key)
+    return {'entropy': seed.entropy, 'spawn_key': list(seed.spawn_key)}
+
+
+class ResultsSink:
+
+    # Appends one JSON line per finished run, lines are kept in memory and written buffer_size at a time so
+    # a crash loses at most the last batch
+    def __init__(self, path, buffer_size=32, append=False):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []
+        if append and os.path.exists(path):
+            drop_partial_line(path)
+        self.file = open(path, 'a' if append else 'w')
+
+
+    def write(self, record):
+        self.buffer.append(json.dumps(record) + '\n')
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def drop_partial_line(path, chunk_size=1 << 16):
+    # Cuts a last line left without its newline by a crash, so the next record doesn't get glued to it
+    with open(path, 'rb+') as file:
+        end = file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - chunk_size)
+            file.seek(start)
+            chunk = file.read(position - start)
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            file.truncate(position)
+
+
+def read_results(path):
+    # Yields the records one at a time, a last line cut off by a crash is skipped
+    if not os.path.exists(path):
+        return
+    with open(path) as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+# Metrics of a record kept in the results cube, one slice of its last axis each
+METRICS = ['neighbourhood_ratio', 'rounds', 'final_unhappy']
+
+# Normal quantile of the 95% confidence band of the mean
+CONFIDENCE_Z = 1.96
+
+
+def record_metrics(record):
+    return [record['neighbourhood_ratio'], record['rounds'], record['unhappy'][-1] if record['unhappy'] else 0]
+
+
+class ResultsCube:
+
+    # Results of a sweep as one float array of shape (thresholds, replicates, metrics), NaN where a run hasn't finished,
+    # every statistic is a single reduction over the replicate axis. The replicate axis grows when a record needs it.
+    # A sweep over other parameters than the threshold gives the row of each record, one per point
+    def __init__(self, replicates=1, thresholds=100):
+        self.data = np.full((thresholds, replicates, len(METRICS)), np.nan)
+
+
+    @classmethod
+    def from_records(cls, records):
+        cube = cls()
+        for record in records:
+            cube.add(record)
+        return cube
+
+
+    def add(self, record, row=None):
+        threshold = record['threshold'] - 1 if row is None else row
+        replicate = record['replicate']
+        if replicate >= self.data.shape[1]:
+            grown = np.full((self.data.shape[0], max(replicate + 1, 2 * self.data.shape[1]), len(METRICS)), np.nan)
+            grown[:, :self.data.shape[1]] = self.data
+            self.data = grown
+        self.data[threshold, replicate] = record_metrics(record)
+
+
+    def metric(self, name='neighbourhood_ratio'):
+        # (thresholds, replicates) view of one metric
+        return self.data[..., METRICS.index(name)]
+
+
+    def finished(self, threshold, replicate):
+        return not np.isnan(self.data[threshold - 1, replicate, 0])
+
+
+    def counts(self):
+        # Number of finished runs of every threshold
+        return np.count_nonzero(~np.isnan(self.data[..., 0]), axis=1)
+
+
+    def statistics(self, name='neighbourhood_ratio', percentiles=(10, 50, 90)):
+        # Dict of arrays over the thresholds that have at least one finished run: threshold (1 to 100) and row (from 0),
+        # count, min, mean, max, std (0 for a single run), the 95% confidence band of the mean and the given percentiles
+        values = self.metric(name)
+        counts = self.counts()
+        rows = np.flatnonzero(counts)
+        values = values[rows]
+        counts = counts[rows]
+        finished = ~np.isnan(values)
+
+        mean = np.where(finished, values, 0).sum(axis=1) / counts
+        squares = np.where(finished, values - mean[:, None], 0) ** 2
+        std = np.sqrt(squares.sum(axis=1) / np.maximum(counts - 1, 1))
+        half_width = CONFIDENCE_Z * std / np.sqrt(counts)
+
+        # Unfinished runs are pushed to the end of each row, the percentiles are interpolated between the first count values
+        ordered = np.sort(np.where(finished, values, np.inf), axis=1)
+        statistics = {
+            'threshold': rows + 1,
+            'row': rows,
+            'count': counts,
+            'min': ordered[:, 0],
+            'mean': mean,
+            'max': ordered[np.arange(rows.size), counts - 1],
+            'std': std,
+            'low': mean - half_width,
+            'high': mean + half_width
+        }
+        for percentile in percentiles:
+            position = (counts - 1) * percentile / 100
+            below = np.floor(position).astype(np.intp)
+            above = np.minimum(below + 1, counts - 1)
+            index = np.arange(rows.size)
+            fraction = position - below
+            statistics['p' + str(percentile)] = ordered[index, below] * (1 - fraction) + ordered[index, above] * fraction
+        return statistics
@@ -0,0 +1,111 @@
+import queue
+import threading
+import time
+import numpy as np
+
+from convergence import ALL_HAPPY, MAX_ITERATIONS
+
+
+STOPPED = 'stopped'
+
+
+class SimulationRunner(threading.Thread):
+
+    # Steps a model in a background thread as fast as it goes. At most max_fps times per second a copy of the board
+    # is put in a bounded queue of frames, a full queue drops its oldest frame so the reader always gets the latest
+    # state. The last frame has the reason of the stop. number_iterations <= 0 runs until the monitor stops it
+    def __init__(self, schelling, monitor, number_iterations, max_fps=30, queue_size=2):
+        threading.Thread.__init__(self, daemon=True)
+        self.schelling = schelling
+        self.monitor = monitor
+        self.number_iterations = number_iterations
+        self.frame_interval = 1 / max_fps
+        self.frames = queue.Queue(queue_size)
+
+        self.running = threading.Event()
+        self.running.set()
+        self.stopping = threading.Event()
+
+        self.iteration = 0
+        self.stop_reason = None
+        self.rate_iteration = 0
+        self.rate_time = 0.0
+        self.rounds_per_second = 0.0
+
+
+    def run(self):
+        self.monitor.reset()
+        self.rate_time = time.perf_counter()
+        next_frame = self.rate_time
+        while True:
+            self.running.wait()
+            if self.stopping.is_set():
+                self.stop_reason = STOPPED
+                break
+            if self.number_iterations > 0 and self.iteration >= self.number_iterations:
+                self.stop_reason = MAX_ITERATIONS
+                break
+            if self.schelling.run_round():
+                self.stop_reason = ALL_HAPPY
+                break
+            self.stop_reason = self.monitor.update(self.schelling)
+            self.iteration += 1
+            if self.stop_reason is not None:
+                break
+
+            now = time.perf_counter()
+            if now >= next_frame:
+                self.publish(now, False)
+                next_frame = now + self.frame_interval
+        self.publish(time.perf_counter(), True)
+
+
+    def publish(self, now, final):
+        if now > self.rate_time:
+            self.rounds_per_second = (self.iteration - self.rate_iteration) / (now - self.rate_time)
+        self.rate_iteration = self.iteration
+        self.rate_time = now
+
+        frame = {
+            'population': np.array(self.schelling.population),
+            'iteration': self.iteration,
+            'rounds_per_second': self.rounds_per_second,
+            'final': final,
+            'stop_reason': self.stop_reason if final else None
+        }
+        while True:
+            try:
+                self.frames.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.frames.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+    def latest_frame(self):
+        # Newest frame waiting in the queue, None when there is none
+        frame = None
+        while True:
+            try:
+                frame = self.frames.get_nowait()
+            except queue.Empty:
+                return frame
+
+
+    def pause(self):
+        self.running.clear()
+
+
+    def resume(self):
+        self.running.set()
+
+
+    def paused(self):
+        return not self.running.is_set()
+
+
+    def stop(self):
+        self.stopping.set()
+        self.running.set()
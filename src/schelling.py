@@ -1,170 +1,21 @@
-import random
 import threading
-import numpy as np
-import matplotlib.pyplot as plt
 
 from tkinter import *
+from tkinter import filedialog
 from time import sleep
-from matplotlib.colors import ListedColormap
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from matplotlib.figure import Figure
 
+from model import *
+from runner import SimulationRunner
+from trajectory import Trajectory, TrajectoryRecorder
 
-class Schelling:
 
-    def __init__(self, width, height, empty_ratio, similarity_threshold, neighbour_depth, races_ratios=None):
-        self.model_configure(width, height, empty_ratio, similarity_threshold, neighbour_depth, races_ratios)
-
-        self.cmap = ListedColormap(['white', 'gold', 'limegreen', 'purple', 'red', 'royalblue'])
-
-    
-    def model_configure(self, width, height, empty_ratio, similarity_threshold, neighbour_depth, races_ratios=None):
-        self.width = width
-        self.height = height
-        self.empty_ratio = empty_ratio
-        self.similarity_threshold = similarity_threshold
-        self.neighbour_depth = neighbour_depth
-
-        if races_ratios:
-            ratios = races_ratios.copy()
-            ratios.insert(0, empty_ratio)
-        else: 
-            ratios = [
-                empty_ratio,
-                (1 - empty_ratio) / 5, 
-                (1 - empty_ratio) / 5,
-                (1 - empty_ratio) / 5,
-                (1 - empty_ratio) / 5,
-                (1 - empty_ratio) / 5
-            ]
-
-        # Actual size of population
-        population_size = width * height
-        # Generate starting placement
-        self.population = np.random.choice([0, 1, 2, 3, 4, 5], size=population_size, p=ratios)
-        # Reshape 1D array to 2D
-        self.population = np.reshape(self.population, (int(self.height), int(self.width)))
-
-
-    def print_to_console(self):
-        print('-' * (len(self.population) * 2 + 2))
-        for x in self.population:
-            row_str = "| "
-            for y in x:
-                if y == 1:
-                    row_str += "# "
-                elif y == 2:
-                    row_str += "O "
-                elif y == 3:
-                    row_str += "* "
-                elif y == 4:
-                    row_str += "+ "
-                elif y == 5:
-                    row_str += "X "
-                else:
-                    row_str += "  "
-            row_str = row_str[:-1] + "|" 
-            print(row_str)
-        print('-' * (len(self.population) * 2 + 2))
-
-
-    def run_round(self):
-        number_unhappy = 0
-        for (row, col), value in np.ndenumerate(self.population):
-            race = self.population[row, col]
-            if race != 0: # not empty
-                neighbourhood = self.get_neighbourhood(row, col)
-
-                neighbourhood_size = np.size(neighbourhood)
-                number_empty_entities = len(np.where(neighbourhood == 0)[0]) # number of empty entities on the neighbourhood
-                
-                if neighbourhood_size != number_empty_entities + 1: # plus the current node
-                    number_similar = len(np.where(neighbourhood == race)[0]) - 1
-                    similarity_ratio = number_similar / (neighbourhood_size - number_empty_entities - 1) 
-                    
-                    if similarity_ratio < self.similarity_threshold: # unhappy
-                        number_unhappy = number_unhappy + 1
-                        try:
-                            empty_entities = list(zip(np.where(self.population == 0)[0], np.where(self.population == 0)[1]))    
-                            random_empty_entity = random.choice(empty_entities)
-                            self.population[random_empty_entity] = race
-                            self.population[row, col] = 0
-                        except IndexError:
-                            pass
-        if number_unhappy == 0:
-            return True
-        return False
-
-
-    def create_plot(self):
-        plt.style.use("ggplot")
-
-        self.fig, self.ax = plt.subplots()
-        
-        self.update_plot()
-
-
-    def update_plot(self):
-        self.ax.clear()
-        self.ax.axis('off')
-        
-        self.ax.pcolormesh(self.population, cmap=self.cmap, edgecolors='w', linewidths=1, vmin=0, vmax=5)
-        self.fig.canvas.draw()
-
-
-    def get_neighbourhood(self, row, col):
-        x_min = max(row - self.neighbour_depth, 0)
-        x_max = min(row + self.neighbour_depth + 1, self.width)
-        y_min = max(col - self.neighbour_depth, 0)
-        y_max = min(col + self.neighbour_depth + 1, self.height)
-        neighbourhood = self.population[x_min:x_max, y_min:y_max]
-        return neighbourhood
-
-
-    def get_ratio_of_individuals_same_race_in_neighbourhood(self, row, col):
-        race = self.population[row, col]
-        neighbourhood = self.get_neighbourhood(row, col)
-        size = np.size(neighbourhood) - 1
-        number = len(np.where(neighbourhood == race)[0]) - 1
-        ratio = number / size
-        return ratio
-
-    def get_race(self, row, col):
-        return self.population[row, col]
-
-    def statistics(self):
-        info_dict = {}
-        info_dict['Number_of_Empty'] = len(np.where(self.population == 0)[0])
-        info_dict['Number_of_RaceA'] = len(np.where(self.population == 1)[0])        
-        info_dict['Number_of_RaceB'] = len(np.where(self.population == 2)[0])        
-        info_dict['Number_of_RaceC'] = len(np.where(self.population == 3)[0])        
-        info_dict['Number_of_RaceD'] = len(np.where(self.population == 4)[0])        
-        info_dict['Number_of_RaceE'] = len(np.where(self.population == 5)[0])      
-
-        races_dict = {}
-        races_dict['1'] = {'1' : 0, '2' : 0, '3' : 0, '4' : 0, '5' : 0}
-        races_dict['2'] = {'1' : 0, '2' : 0, '3' : 0, '4' : 0, '5' : 0}
-        races_dict['3'] = {'1' : 0, '2' : 0, '3' : 0, '4' : 0, '5' : 0}
-        races_dict['4'] = {'1' : 0, '2' : 0, '3' : 0, '4' : 0, '5' : 0}
-        races_dict['5'] = {'1' : 0, '2' : 0, '3' : 0, '4' : 0, '5' : 0}
-
-        for (row, col), value in np.ndenumerate(self.population):
-            race = self.population[row, col]
-            if race != 0:
-                neighbourhood = self.get_neighbourhood(row, col)
-
-                number_empty_entities = len(np.where(neighbourhood == 0)[0])
-                races_dict[str(race)]['1'] += len(np.where(neighbourhood == 1)[0]) 
-                races_dict[str(race)]['2'] += len(np.where(neighbourhood == 2)[0]) 
-                races_dict[str(race)]['3'] += len(np.where(neighbourhood == 3)[0]) 
-                races_dict[str(race)]['4'] += len(np.where(neighbourhood == 4)[0]) 
-                races_dict[str(race)]['5'] += len(np.where(neighbourhood == 5)[0])
-                races_dict[str(race)][str(race)] -= 1
-
-        info_dict['races_dict'] = races_dict
-
-        return info_dict
+# Most frames per second displayed while a simulation runs
+MAX_FPS = 30
 
+# File the runs started with Record checked are logged to
+RECORDING_PATH = 'simulation.trajectory'
 
 
 class Application(Tk):
@@ -193,6 +44,14 @@ class Application(Tk):
     def create_and_add_model(self):
         self.number_iterations = 20
         self.schelling = Schelling(10, 10, 0.5, 0.8, 1)
+        self.monitor = ConvergenceMonitor()
+        # Thread stepping the model while Start runs, None when stopped
+        self.runner = None
+        # Recorder of the running simulation and recording browsed with the scrubber, None when there is none
+        self.recorder = None
+        self.trajectory = None
+        # Round of the recording on the canvas, so moving the scrubber to it doesn't draw it again
+        self.shown_round = None
         self.schelling.create_plot()
         self.draw_canvas()
         
@@ -350,6 +209,29 @@ class Application(Tk):
         self.step_button = Button(self.button_row_frame, text='Step', width=15, bg='black', fg='white')
         self.step_button.pack(side=LEFT)
 
+        self.control_row_frame = Frame(self.right_frame)
+        self.control_row_frame.pack(side=BOTTOM, pady=0)
+
+        self.pause_button = Button(self.control_row_frame, text='Pause', width=15, bg='gray30', fg='white', state="disabled")
+        self.pause_button.pack(side=LEFT)
+        self.stop_button = Button(self.control_row_frame, text='Stop', width=15, bg='gray30', fg='white', state="disabled")
+        self.stop_button.pack(side=LEFT)
+
+        self.replay_frame = Frame(self.right_frame)
+        self.replay_frame.pack(side=BOTTOM, pady=10)
+
+        self.replay_row_frame = Frame(self.replay_frame)
+        self.replay_row_frame.pack(side=TOP)
+        self.record_value = BooleanVar()
+        self.record_button = Checkbutton(self.replay_row_frame, text="Record", variable=self.record_value)
+        self.record_button.pack(side=LEFT)
+        self.open_recording_button = Button(self.replay_row_frame, text='Open Recording', width=15)
+        self.open_recording_button.pack(side=LEFT)
+
+        # Scrubber over the rounds of the open recording
+        self.replay_scale = Scale(self.replay_frame, orient=HORIZONTAL, length=250, from_=0, to=0, label="Recorded Round", state="disabled")
+        self.replay_scale.pack(side=TOP)
+
 
         self.button_top_row_frame = Frame(self.right_frame)
         self.button_top_row_frame.pack(side=BOTTOM, pady=0)
@@ -376,6 +258,10 @@ class Application(Tk):
 
         self.start_button.configure(command=self.run_graph)
         self.step_button.configure(command=self.run_round)
+        self.pause_button.configure(command=self.toggle_pause)
+        self.stop_button.configure(command=self.stop_graph)
+        self.open_recording_button.configure(command=self.open_recording)
+        self.replay_scale.configure(command=self.seek)
 
         self.load_button.configure(command=self.validate_and_update)
 
@@ -385,26 +271,109 @@ class Application(Tk):
         
 
     def run_graph(self):
-        self.start_button.config(state="disabled")
-        if self.number_iterations > 0:
-            for i in range(self.number_iterations): 
-                if self.run_round():
-                    break
-                self.simulation_status_label.config(text="Iteration " + str(i + 1))
+        # The rounds run in a worker thread, the Tk loop only draws the latest frame it made, at most MAX_FPS times
+        # per second. A number of iterations less or equal than 0 runs until the monitor detects a steady state
+        if self.runner is not None:
+            return
+        if self.record_value.get():
+            self.close_trajectory()
+            self.recorder = TrajectoryRecorder(RECORDING_PATH).attach(self.schelling)
+        self.runner = SimulationRunner(self.schelling, self.monitor, self.number_iterations, MAX_FPS)
+        self.set_running(True)
+        self.runner.start()
+        self.after(1000 // MAX_FPS, self.poll_frames)
+
+
+    def poll_frames(self):
+        frame = self.runner.latest_frame()
+        if frame is not None:
+            self.schelling.update_plot(frame['population'])
+            if frame['final']:
+                self.simulation_status_label.config(text="Stopped after " + str(frame['iteration']) + " iterations: " + frame['stop_reason'])
+                self.runner.join()
+                self.runner = None
+                self.set_running(False)
+                if self.recorder is not None:
+                    self.recorder.detach(self.schelling)
+                    self.recorder = None
+                    self.open_trajectory(RECORDING_PATH, False)
+                return
+            self.simulation_status_label.config(text="Iteration " + str(frame['iteration']) + " (" + str(round(frame['rounds_per_second'], 1)) + " rounds/s)")
+        self.after(1000 // MAX_FPS, self.poll_frames)
+
+
+    def toggle_pause(self):
+        if self.runner is None:
+            return
+        if self.runner.paused():
+            self.runner.resume()
+            self.pause_button.config(text="Pause")
         else:
-            i = 0
-            while True:
-                if self.run_round():
-                    break
-                i = i + 1
-                self.simulation_status_label.config(text="Iteration " + str(i + 1))
-        self.start_button.config(state="normal")
-            
+            self.runner.pause()
+            self.pause_button.config(text="Resume")
+
+
+    def stop_graph(self):
+        if self.runner is not None:
+            self.runner.stop()
+
+
+    def open_recording(self):
+        path = filedialog.askopenfilename(title="Open Recording", filetypes=[("Recordings", "*.trajectory"), ("All files", "*")])
+        if path:
+            self.open_trajectory(path)
+
+
+    def open_trajectory(self, path, show_start=True):
+        # The scrubber browses the recording without touching the model, Step and Start carry on from the model's board
+        self.close_trajectory()
+        try:
+            self.trajectory = Trajectory(path)
+        except (OSError, ValueError) as error:
+            self.simulation_status_label.config(text="Can't open " + str(path) + ": " + str(error))
+            return
+        # A recording just made ends on the board already drawn, the scrubber is put there without drawing it again
+        self.shown_round = None if show_start else self.trajectory.rounds
+        self.replay_scale.config(state="normal", to=self.trajectory.rounds)
+        self.replay_scale.set(0 if show_start else self.trajectory.rounds)
+        if show_start:
+            self.seek(0)
+
+
+    def close_trajectory(self):
+        if self.trajectory is not None:
+            self.trajectory.close()
+            self.trajectory = None
+        self.replay_scale.config(to=0, state="disabled")
+
+
+    def seek(self, value):
+        # Called by the scrubber, also when it is moved by the program
+        if self.trajectory is None or self.runner is not None:
+            return
+        round_number = int(float(value))
+        if round_number == self.shown_round:
+            return
+        self.shown_round = round_number
+        self.schelling.update_plot(self.trajectory.board(round_number))
+        self.simulation_status_label.config(text="Recorded round " + str(round_number) + " of " + str(self.trajectory.rounds))
+
+
+    def set_running(self, running):
+        # The model belongs to the worker thread while it runs, everything that touches it is disabled
+        idle = "disabled" if running else "normal"
+        active = "normal" if running else "disabled"
+        for button in [self.start_button, self.step_button, self.load_button, self.stats_button, self.record_button, self.open_recording_button]:
+            button.config(state=idle)
+        self.pause_button.config(state=active, text="Pause")
+        self.stop_button.config(state=active)
+
 
     def run_round(self):
+        # update_plot blits the new frame itself, the canvas no longer shows the recording
+        self.shown_round = None
         result = self.schelling.run_round()
         self.schelling.update_plot()
-        self.canvas.draw()
 
         return result
     
@@ -427,8 +396,9 @@ class Application(Tk):
 
 
     def generate_random_races_with_random_ratios(self):
-        number_races = random.randint(2,5)
-        empty_ratio = round(random.uniform(0, 1), 2)
+        rng = self.schelling.rng
+        number_races = int(rng.integers(2, 6))
+        empty_ratio = round(rng.uniform(0, 1), 2)
         self.empty_ratio_box.configure(state="normal")
         self.empty_ratio_box.delete(0, END)
         self.empty_ratio_box.insert(0, empty_ratio)
@@ -439,7 +409,7 @@ class Application(Tk):
             if j == number_races - 1:
                 race_ratio = round(1 - ratio_total, 2)
             else:
-                race_ratio = round(random.uniform(0, 1 - ratio_total), 2)
+                race_ratio = round(rng.uniform(0, 1 - ratio_total), 2)
             self.races_ratio_boxes[j].configure(state="normal")
             self.races_ratio_boxes[j].delete(0, END)
             self.races_ratio_boxes[j].insert(0, race_ratio)
@@ -550,6 +520,12 @@ class Application(Tk):
 
 
     def _quit(self):
+        if self.runner is not None:
+            self.runner.stop()
+            self.runner.join()
+        if self.recorder is not None:
+            self.recorder.detach(self.schelling)
+        self.close_trajectory()
         self.quit()
         self.destroy()
 
@@ -0,0 +1,51 @@
+import json
+import os
+import numpy as np
+
+from neighbourhood import POPULATION_DTYPE
+
+
+# The board lives in a raw uint8 file, the parameters and the generator state needed to resume a run
+# are kept next to it in a small JSON file
+def metadata_path(path):
+    return str(path) + '.json'
+
+
+def create_grid(path, height, width):
+    return np.memmap(path, dtype=POPULATION_DTYPE, mode='w+', shape=(int(height), int(width)))
+
+
+def open_grid(path, height, width):
+    return np.memmap(path, dtype=POPULATION_DTYPE, mode='r+', shape=(int(height), int(width)))
+
+
+def write_metadata(path, metadata):
+    with open(metadata_path(path), 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+
+
+def read_metadata(path):
+    with open(metadata_path(path)) as metadata_file:
+        return json.load(metadata_file)
+
+
+def save_run_state(path, state, monitor_state=None):
+    # Arrays of Schelling.get_state go to an npz file with the rest as JSON, written beside and then renamed
+    # so an interrupted save leaves the previous state in place
+    arrays = {key: value for key, value in state.items() if isinstance(value, np.ndarray)}
+    metadata = {key: value for key, value in state.items() if key not in arrays}
+    metadata['monitor'] = monitor_state
+    temporary = str(path) + '.tmp'
+    with open(temporary, 'wb') as state_file:
+        np.savez(state_file, metadata=json.dumps(metadata), **arrays)
+    os.replace(temporary, path)
+
+
+def load_run_state(path):
+    # Returns (state, monitor_state) as saved by save_run_state
+    with np.load(path) as data:
+        state = json.loads(str(data['metadata']))
+        for key in data.files:
+            if key != 'metadata':
+                state[key] = data[key]
+    return state, state.pop('monitor')
@@ -0,0 +1,251 @@
+from model import Schelling, random_population, seed_sequence
+from convergence import ConvergenceMonitor
+from neighbourhood import Neighbourhood
+from results import *
+from cache import ResultCache, job_key
+import argparse
+import configparser
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import numpy as np
+
+
+# Parameters of Schelling a sweep can vary, the others keep the value of the DEFAULT section of the config file
+PARAMETERS = ['similarity_threshold', 'empty_ratio', 'neighbour_depth', 'size', 'races_ratios', 'neighbourhood_shape', 'boundary', 'radius']
+
+# Parameters the starting board depends on, with common random numbers the points that share them share their boards
+POPULATION_PARAMETERS = ['size', 'empty_ratio', 'races_ratios']
+
+
+def parse_values(name, text):
+    # 'a, b, c' is a list and 'start:stop:step' an inclusive range. Sizes are written WIDTHxHEIGHT, race ratios as
+    # space-separated numbers with ';' between the entries
+    if name == 'size':
+        return [tuple(int(side) for side in value.lower().split('x')) for value in text.split(',')]
+    if name == 'races_ratios':
+        return [[float(ratio) for ratio in value.split()] for value in text.split(';')]
+    if name in ('neighbourhood_shape', 'boundary'):
+        return [value.strip() for value in text.split(',')]
+    if ':' in text:
+        start, stop, step = (float(value) for value in text.split(':'))
+        values = [round(start + step * number, 10) for number in range(int(round((stop - start) / step)) + 1)]
+    else:
+        values = [float(value) for value in text.split(',')]
+    if name == 'neighbour_depth':
+        return [int(value) for value in values]
+    return values
+
+
+def point_ratios(point):
+    # Race ratios are shares of the individuals, scaled to the occupied part of the board of the point
+    ratios = list(point['races_ratios']) + [0] * (5 - len(point['races_ratios']))
+    total = sum(ratios)
+    return [ratio * (1 - point['empty_ratio']) / total for ratio in ratios]
+
+
+def sweep_points(base, axes, combine='grid'):
+    # Every combination of the values of the axes ('grid'), or their values taken side by side ('zip'), on top of base
+    names = list(axes)
+    if combine == 'grid':
+        combinations = itertools.product(*axes.values())
+    elif combine == 'zip':
+        if len({len(values) for values in axes.values()}) > 1:
+            raise ValueError("combine = zip needs the same number of values for every parameter")
+        combinations = zip(*axes.values())
+    else:
+        raise ValueError("Unknown combine '" + str(combine) + "', expected grid or zip")
+    return [dict(base, **dict(zip(names, combination))) for combination in combinations]
+
+
+def child_seed(seed, *key):
+    return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + key)
+
+
+def parameters_key(point, names):
+    # Integer digest of the values of names in point, the spawn key of the seeds of the point so they only depend on
+    # its own parameters and not on where the point comes in the sweep
+    text = json.dumps([point[name] for name in names])
+    return int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], 'little')
+
+
+def run_points(job):
+    # Runs every point of a job from one starting board, drawn once from the job's seed and copied by each run. Every
+    # run draws its moves from the same stream too, so the points differ by their parameters and not by their luck.
+    # Can be called from a worker process
+    first = job['points'][0][1]
+    width, height = first['size']
+    population = random_population(np.random.default_rng(child_seed(job['seed'], 0)), width, height, first['empty_ratio'], point_ratios(first))
+
+    records = []
+    for point_index, point in job['points']:
+        neighbourhood = Neighbourhood(point['neighbour_depth'], point['neighbourhood_shape'], point['boundary'], point['radius'])
+        rng = np.random.default_rng(child_seed(job['seed'], 1))
+        schelling = Schelling(width, height, point['empty_ratio'], point['similarity_threshold'], neighbourhood, seed=rng, population=population)
+        monitor = ConvergenceMonitor(job['convergencewindow'], job['convergencetolerance'])
+        rounds, stop_reason = schelling.run(job['maxiterations'], monitor)
+        records.append({
+            'point': point_index,
+            'replicate': job['replicate'],
+            'parameters': point,
+            'seed': seed_record(job['seed']),
+            'rounds': rounds,
+            'stop_reason': stop_reason,
+            'unhappy': schelling.unhappy_history,
+            'neighbourhood_ratio': schelling.neighbourhood_numbers(),
+            'race_adjacency': schelling.race_adjacency().tolist()
+        })
+    return records
+
+
+def record_key(job, point):
+    # Cache key of the run of one point of a job, which only depends on that point, the seed and the run settings
+    return job_key(dict({key: value for key, value in job.items() if key != 'points'}, point=point))
+
+
+class ParameterSweep:
+
+    # Runs nsimulations replicates of every point of a grid (or list) of Schelling parameters declared in the [sweep]
+    # section of a config file, the DEFAULT section giving the values of the others as for graph.py. With common
+    # random numbers (the default) replicate r of every point that draws the same kind of board starts from the
+    # same board, generated once per replicate, which lowers the variance of the differences between points
+    def __init__(self, confFile, workers=None, seed=None, use_cache=True):
+        # DEFAULT is read as a section of its own, so the [sweep] section only holds what it declares
+        config = configparser.ConfigParser(default_section='')
+        config.read(confFile)
+        defaults = config['DEFAULT']
+        settings = config['sweep']
+
+        self.simulations = defaults.getint('nsimulations')
+        self.maxiterations = defaults.getint('maxniterations')
+        self.convergencewindow = defaults.getint('convergencewindow', 100)
+        self.convergencetolerance = defaults.getfloat('convergencetolerance', 0.01)
+        self.workers = defaults.getint('nworkers', 1) if workers is None else workers
+        if self.workers <= 0:
+            self.workers = os.cpu_count()
+        self.seed = defaults.getint('seed', None) if seed is None else seed
+
+        base = {
+            'similarity_threshold': defaults.getfloat('threshold', 0.5),
+            'empty_ratio': defaults.getfloat('emptyratio'),
+            'neighbour_depth': defaults.getint('ndepth'),
+            'size': (defaults.getint('popwidth'), defaults.getint('popheight')),
+            'races_ratios': [defaults.getfloat(key) for key in ('raratio', 'rbratio', 'rcratio', 'rdratio', 'reratio')],
+            'neighbourhood_shape': defaults.get('neighbourhood', 'moore'),
+            'boundary': defaults.get('boundary', 'open'),
+            'radius': defaults.getfloat('radius', None)
+        }
+        axes = {name: parse_values(name, settings[name]) for name in settings if name in PARAMETERS}
+        unknown = [name for name in settings if name not in PARAMETERS + ['combine', 'commonrandom', 'output']]
+        if unknown:
+            raise ValueError("Unknown sweep parameters: " + ", ".join(unknown) + ", expected " + ", ".join(PARAMETERS))
+        self.points = sweep_points(base, axes, settings.get('combine', 'grid'))
+        self.commonrandom = settings.getboolean('commonrandom', True)
+        self.output = settings.get('output', None)
+        if self.output:
+            self.output = os.path.join(os.path.dirname(os.path.abspath(confFile)), self.output)
+
+        self.cache = None
+        cachedir = defaults.get('cache', '.schelling-cache')
+        if cachedir and use_cache and self.seed is not None:
+            self.cache = ResultCache(os.path.join(os.path.dirname(os.path.abspath(confFile)), cachedir), defaults.getint('cachesize', 256) * 2 ** 20)
+
+        # (point, replicate, metric) array of the finished runs
+        self.cube = ResultsCube(self.simulations, len(self.points))
+        self.seed_sequence = seed_sequence(self.seed)
+
+
+    def jobs(self):
+        # One job per replicate and kind of board with common random numbers, one per replicate and point without.
+        # The seed of a job is derived from the parameters its points share, so adding, removing or reordering the
+        # values of a sweep leaves the runs of the other points unchanged
+        names = POPULATION_PARAMETERS if self.commonrandom else PARAMETERS
+        groups = {}
+        for index, point in enumerate(self.points):
+            groups.setdefault(parameters_key(point, names), []).append((index, point))
+
+        jobs = []
+        for key, points in groups.items():
+            for replicate in range(self.simulations):
+                jobs.append({
+                    'points': points,
+                    'replicate': replicate,
+                    'seed': child_seed(self.seed_sequence, replicate, key),
+                    'maxiterations': self.maxiterations,
+                    'convergencewindow': self.convergencewindow,
+                    'convergencetolerance': self.convergencetolerance
+                })
+        return jobs
+
+
+    def run(self):
+        # Runs are cached one (point, replicate) at a time, a job only runs the points of its group that miss, on the
+        # same board and draws as the whole group would
+        jobs = []
+        cached = []
+        for job in self.jobs():
+            missing = []
+            for index, point in job['points']:
+                record = self.cache.get(record_key(job, point)) if self.cache is not None else None
+                if record is None:
+                    missing.append((index, point))
+                else:
+                    cached.append(dict(record, point=index))
+            if missing:
+                jobs.append(dict(job, points=missing))
+        if cached:
+            print(len(cached), 'of', len(self.points) * self.simulations, 'runs reused from the cache')
+
+        sink = ResultsSink(self.output) if self.output else None
+        pool = multiprocessing.Pool(self.workers) if self.workers > 1 and len(jobs) > 1 else None
+        try:
+            self.collect(cached, sink)
+            if pool is not None:
+                computed_results = pool.imap(run_points, jobs)
+            else:
+                computed_results = map(run_points, jobs)
+            for job, records in zip(jobs, computed_results):
+                if self.cache is not None:
+                    for record in records:
+                        self.cache.put(record_key(job, record['parameters']), record)
+                self.collect(records, sink)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if sink is not None:
+                sink.close()
+        return self.cube
+
+
+    def collect(self, records, sink=None):
+        for record in records:
+            self.cube.add(record, record['point'])
+            if sink is not None:
+                sink.write(record)
+
+
+    def table(self, metric='neighbourhood_ratio'):
+        # One line per point: the parameters that vary, then the statistics of the metric over the replicates
+        statistics = self.cube.statistics(metric, percentiles=())
+        varying = [name for name in PARAMETERS if len({json.dumps(point[name]) for point in self.points}) > 1]
+        lines = ["\t".join(varying + ['count', 'mean', 'std', 'low', 'high'])]
+        for row, point in enumerate(statistics['row'].tolist()):
+            values = [str(self.points[point][name]) for name in varying]
+            values += [str(statistics['count'][row])] + [str(round(float(statistics[key][row]), 4)) for key in ('mean', 'std', 'low', 'high')]
+            lines.append("\t".join(values))
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage='python sweep.py configFilePath [--workers N] [--seed S] [--no-cache]')
+    parser.add_argument('config')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes, 0 uses every core')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='seed of the sweep, overrides the one in the config file')
+    parser.add_argument('--no-cache', dest='cache', action='store_false', help='run every simulation, without reading or filling the result cache')
+    args = parser.parse_args()
+
+    sweep = ParameterSweep(args.config, args.workers, args.seed, args.cache)
+    sweep.run()
+    print(sweep.table())
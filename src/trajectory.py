@@ -0,0 +1,260 @@
+import bisect
+import json
+import struct
+import numpy as np
+
+from model import pack_population, unpack_population, POPULATION_DTYPE
+
+
+# A trajectory file starts with MAGIC and a JSON header, then holds one chunk per round: the moves of the round, or a
+# keyframe (the whole board, 3 bits per cell) when the moves would take as much room, so a round never costs more than
+# a packed board. On close an index of the keyframes is appended, followed by its offset and MAGIC again. A file cut
+# short by a crash has no index, reading it scans the chunks
+MAGIC = b'SCHTRJ1\n'
+
+# Chunk header: kind, round, payload length
+CHUNK = struct.Struct('<cQQ')
+MOVES = b'M'
+KEYFRAME = b'K'
+INDEX = b'I'
+
+# Most rounds between two keyframes, a round is also stored as a keyframe as soon as the moves since the last one
+# would be as large as it
+KEYFRAME_INTERVAL = 1000
+
+
+def move_dtype(index_dtype):
+    return np.dtype([('from', index_dtype), ('to', index_dtype), ('race', POPULATION_DTYPE)])
+
+
+def pair_moves(changed, old, new, dtype):
+    # Moves giving the change of the changed cells from old to new values: the cells a race left and the cells it
+    # entered, paired in cell order. An individual moved twice in a round shows as a single move
+    left = old != 0
+    entered = new != 0
+    sources = changed[left]
+    destinations = changed[entered]
+    source_order = np.argsort(old[left], kind='stable')
+    destination_order = np.argsort(new[entered], kind='stable')
+    races = old[left][source_order]
+    if not np.array_equal(races, new[entered][destination_order]):
+        raise ValueError("The board changed by something else than moves, a recording follows a single run")
+
+    moves = np.empty(sources.size, dtype=dtype)
+    moves['from'] = sources[source_order]
+    moves['to'] = destinations[destination_order]
+    moves['race'] = races
+    return moves
+
+
+def apply_moves(cells, moves):
+    # Every cell left is emptied before any is entered, a cell left and entered in the same round ends up entered
+    cells[moves['from']] = 0
+    cells[moves['to']] = moves['race']
+
+
+class TrajectoryRecorder:
+
+    # Logs every round of a model to a trajectory file. Attaching wraps run_round on the instance, like the profiler
+    # does, so a model without a recorder pays nothing. The moves of a round are the difference between the board and
+    # a copy of it kept by the recorder, which works with every engine
+    def __init__(self, path, keyframe_interval=KEYFRAME_INTERVAL):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.file = None
+        self.wrapped = None
+
+
+    def attach(self, schelling):
+        height, width = schelling.population.shape
+        self.index_dtype = np.dtype(np.uint32 if height * width < 2 ** 32 else np.uint64)
+        self.dtype = move_dtype(self.index_dtype)
+        self.previous = np.array(schelling.population).reshape(-1)
+        self.round = 0
+        self.keyframes = []
+
+        self.file = open(self.path, 'wb')
+        header = json.dumps({'height': height, 'width': width, 'index_dtype': self.index_dtype.name, 'start_round': schelling.round_number}).encode()
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.write_keyframe()
+
+        self.wrapped = schelling.__dict__.get('run_round')
+        run_round = schelling.run_round
+
+        def recorded_run_round():
+            finished = run_round()
+            self.record(schelling)
+            return finished
+
+        schelling.run_round = recorded_run_round
+        return self
+
+
+    def detach(self, schelling):
+        if self.wrapped is None:
+            schelling.__dict__.pop('run_round', None)
+        else:
+            schelling.run_round = self.wrapped
+        self.close()
+
+
+    def write_chunk(self, kind, payload):
+        self.file.write(CHUNK.pack(kind, self.round, len(payload)))
+        self.file.write(payload)
+
+
+    def write_keyframe(self):
+        self.keyframes.append((self.round, self.file.tell()))
+        packed = pack_population(self.previous).tobytes()
+        self.keyframe_bytes = len(packed)
+        self.moves_bytes = 0
+        self.write_chunk(KEYFRAME, packed)
+
+
+    def record(self, schelling):
+        self.round += 1
+        cells = schelling.population.reshape(-1)
+        changed = np.flatnonzero(cells != self.previous)
+        old = self.previous[changed]
+        new = cells[changed]
+        self.previous[changed] = new
+
+        payload = pair_moves(changed.astype(self.index_dtype), old, new, self.dtype).tobytes()
+        if self.round - self.keyframes[-1][0] >= self.keyframe_interval or self.moves_bytes + len(payload) >= self.keyframe_bytes:
+            self.write_keyframe()
+        else:
+            self.write_chunk(MOVES, payload)
+            self.moves_bytes += len(payload)
+
+
+    def close(self):
+        if self.file is None or self.file.closed:
+            return
+        offset = self.file.tell()
+        self.write_chunk(INDEX, np.array([self.round] + [value for keyframe in self.keyframes for value in keyframe], dtype=np.int64).tobytes())
+        self.file.write(struct.pack('<Q', offset) + MAGIC)
+        self.file.close()
+
+
+class Trajectory:
+
+    # Reads a trajectory file. board(round) starts from the last keyframe at or before round and replays the moves
+    # from there, or carries on from the board it returned last when that is closer
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(str(path) + " is not a trajectory file")
+        length, = struct.unpack('<I', self.file.read(4))
+        header = json.loads(self.file.read(length))
+        self.height = header['height']
+        self.width = header['width']
+        self.start_round = header['start_round']
+        self.dtype = move_dtype(np.dtype(header['index_dtype']))
+        self.first_chunk = self.file.tell()
+
+        if not self.read_index():
+            self.scan()
+        self.keyframe_rounds = [round_number for round_number, _ in self.keyframes]
+
+        # Last board returned, with its round and the offset of the chunk that follows it
+        self.current = None
+        self.current_round = None
+        self.current_offset = None
+
+
+    def read_index(self):
+        end = self.file.seek(0, 2)
+        if end < self.first_chunk + CHUNK.size + 8 + len(MAGIC):
+            return False
+        self.file.seek(end - 8 - len(MAGIC))
+        offset, = struct.unpack('<Q', self.file.read(8))
+        if self.file.read(len(MAGIC)) != MAGIC:
+            return False
+        self.file.seek(offset)
+        kind, _, length = CHUNK.unpack(self.file.read(CHUNK.size))
+        if kind != INDEX:
+            return False
+        index = np.frombuffer(self.file.read(length), dtype=np.int64)
+        self.rounds = int(index[0])
+        self.keyframes = [(int(round_number), int(position)) for round_number, position in index[1:].reshape(-1, 2)]
+        return True
+
+
+    def scan(self):
+        # Walks the chunk headers of a file left without an index, a chunk cut short ends the recording
+        end = self.file.seek(0, 2)
+        position = self.first_chunk
+        self.rounds = 0
+        self.keyframes = []
+        while position + CHUNK.size <= end:
+            self.file.seek(position)
+            kind, round_number, length = CHUNK.unpack(self.file.read(CHUNK.size))
+            if position + CHUNK.size + length > end or kind == INDEX:
+                break
+            if kind == KEYFRAME:
+                self.keyframes.append((round_number, position))
+            elif kind == MOVES:
+                self.rounds = round_number
+            position += CHUNK.size + length
+        if not self.keyframes:
+            raise ValueError("The trajectory file has no keyframe")
+        self.rounds = max(self.rounds, self.keyframes[-1][0])
+
+
+    def read_chunk(self, offset):
+        self.file.seek(offset)
+        kind, round_number, length = CHUNK.unpack(self.file.read(CHUNK.size))
+        return kind, round_number, self.file.read(length), offset + CHUNK.size + length
+
+
+    def board(self, round_number):
+        # The board after round_number rounds of the recording, 0 being the board it started from
+        if not 0 <= round_number <= self.rounds:
+            raise IndexError("Round " + str(round_number) + " is outside of the recording (0 to " + str(self.rounds) + ")")
+        keyframe = bisect.bisect_right(self.keyframe_rounds, round_number) - 1
+        if self.current is None or not self.keyframe_rounds[keyframe] <= self.current_round <= round_number:
+            _, _, payload, offset = self.read_chunk(self.keyframes[keyframe][1])
+            self.current = unpack_population(np.frombuffer(payload, dtype=np.uint8), self.height, self.width).reshape(-1)
+            self.current_round = self.keyframe_rounds[keyframe]
+            self.current_offset = offset
+
+        while self.current_round < round_number:
+            kind, chunk_round, payload, self.current_offset = self.read_chunk(self.current_offset)
+            if chunk_round <= self.current_round:
+                continue
+            if kind == MOVES:
+                apply_moves(self.current, np.frombuffer(payload, dtype=self.dtype))
+            else:
+                self.current = unpack_population(np.frombuffer(payload, dtype=np.uint8), self.height, self.width).reshape(-1)
+            self.current_round = chunk_round
+        return self.current.reshape(self.height, self.width).copy()
+
+
+    def moves(self, round_number):
+        # Structured array of the (from, to, race) moves of a round, cells as flat indices. A round stored as a keyframe
+        # has its moves rebuilt from the difference with the board before it, as the recorder would have found them
+        if not 1 <= round_number <= self.rounds:
+            raise IndexError("Round " + str(round_number) + " is outside of the recording (1 to " + str(self.rounds) + ")")
+        keyframe = bisect.bisect_right(self.keyframe_rounds, round_number) - 1
+        if self.keyframe_rounds[keyframe] == round_number:
+            previous = self.board(round_number - 1).reshape(-1)
+            cells = self.board(round_number).reshape(-1)
+            changed = np.flatnonzero(cells != previous)
+            return pair_moves(changed.astype(self.dtype['from']), previous[changed], cells[changed], self.dtype)
+        offset = self.keyframes[keyframe][1]
+        while True:
+            kind, chunk_round, payload, offset = self.read_chunk(offset)
+            if kind == MOVES and chunk_round == round_number:
+                return np.frombuffer(payload, dtype=self.dtype).copy()
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()